@@ -1,23 +1,61 @@
 # -- app.py (tek dosyalık ERP/MES API) --
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel
 from typing import Optional, List
 from datetime import datetime, timedelta
+import contextvars, csv, heapq, io, itertools, json, logging, os, random, sys, threading, time, traceback, zlib
+from collections import OrderedDict, namedtuple
 import jwt
 from passlib.context import CryptContext
-from sqlalchemy import create_engine, Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, select, desc, Table, UniqueConstraint
-from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship
+from sqlalchemy import event, func, inspect, text, bindparam, literal, case, create_engine, Column, Integer, String, Float, Boolean, ForeignKey, DateTime, Text, select, desc, insert, update, or_, Index, Table, UniqueConstraint
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.orm import sessionmaker, declarative_base, Session, relationship, aliased
 
-DB_URL = "sqlite:///./fixar.db"
-engine = create_engine(DB_URL, future=True, echo=False, connect_args={"check_same_thread": False})
+# ---- Depolama ayarları (ortam değişkenleri) ----
+# DB_URL / DB_READ_URL, DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_WAL (1/0),
+# SQLITE_SYNCHRONOUS, SQLITE_CACHE_SIZE (KiB için negatif), SQLITE_MMAP_SIZE, SQLITE_BUSY_TIMEOUT (ms)
+DB_URL = os.getenv("DB_URL","sqlite:///./fixar.db")
+DB_READ_URL = os.getenv("DB_READ_URL", DB_URL)
+SQLITE_PRAGMAS = {
+    "journal_mode": "WAL" if os.getenv("DB_WAL","1")=="1" else "DELETE",
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS","NORMAL"),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE","-65536")),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE","268435456")),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT","5000")),
+}
+
+def make_engine(url:str, readonly:bool=False):
+    if not url.startswith("sqlite"):
+        return create_engine(url, future=True, echo=False, pool_pre_ping=True,
+                             pool_size=int(os.getenv("DB_POOL_SIZE","5")), max_overflow=int(os.getenv("DB_MAX_OVERFLOW","10")))
+    eng=create_engine(url, future=True, echo=False, connect_args={"check_same_thread": False},
+                      pool_size=int(os.getenv("DB_POOL_SIZE","5")), max_overflow=int(os.getenv("DB_MAX_OVERFLOW","10")))
+    @event.listens_for(eng, "connect")
+    def _pragmas(dbapi_con, rec):
+        cur=dbapi_con.cursor()
+        for k,v in SQLITE_PRAGMAS.items(): cur.execute(f"PRAGMA {k}={v}")
+        if readonly: cur.execute("PRAGMA query_only=ON")
+        cur.close()
+    return eng
+
+engine = make_engine(DB_URL)
+read_engine = make_engine(DB_READ_URL, readonly=True)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True)
+ReadSessionLocal = sessionmaker(bind=read_engine, autoflush=False, autocommit=False, future=True)
 Base = declarative_base()
 def get_db():
     db=SessionLocal()
     try: yield db
     finally: db.close()
+def get_read_db():
+    # GET uçları: WAL ile yazmalar sürerken paralel okur
+    db=ReadSessionLocal()
+    try: yield db
+    finally: db.close()
 
 SECRET="fixar-secret"; ALGO="HS256"
 pwd=CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -26,17 +64,66 @@ def hash_pw(p): return pwd.hash(p)
 def verify_pw(p,h): return pwd.verify(p,h)
 def make_token(sub): return jwt.encode({"sub":sub,"exp":datetime.utcnow()+timedelta(hours=12)}, SECRET, algorithm=ALGO)
 def decode_token(t): return jwt.decode(t, SECRET, algorithms=[ALGO])
-def get_user(creds:HTTPAuthorizationCredentials=Depends(bearer), db:Session=Depends(get_db)):
+Principal=namedtuple("Principal","id username is_active roles")  # roles: frozenset[str]
+
+class PrincipalCache:
+    """Token sub -> Principal; TTL'li, boyut sınırlı LRU. Süreç içidir: diğer worker'ların
+    kullanıcı/rol değişiklikleri cache_generations('principals') ile en geç check_interval saniyede görünür."""
+    def __init__(self, ttl:float=60.0, maxsize:int=1024, check_interval:float=1.0):
+        self.ttl=ttl; self.maxsize=maxsize; self.hits=0; self.misses=0
+        self.epoch=0; self.gen=None; self.checked=0.0; self.check_interval=check_interval
+        self._d=OrderedDict(); self._lock=threading.Lock()
+    def get(self, key):
+        with self._lock:
+            v=self._d.get(key)
+            if v and v[0]>time.monotonic():
+                self._d.move_to_end(key); self.hits+=1; return v[1]
+            if v: del self._d[key]
+            self.misses+=1; return None
+    def put(self, key, val, epoch=None):
+        with self._lock:
+            if epoch is not None and epoch!=self.epoch: return  # yükleme sürerken geçersizlendi: eski veriyi yazma
+            self._d[key]=(time.monotonic()+self.ttl, val); self._d.move_to_end(key)
+            while len(self._d)>self.maxsize: self._d.popitem(last=False)
+    def invalidate(self, key=None):
+        with self._lock:
+            self.epoch+=1
+            if key is None: self._d.clear()
+            else: self._d.pop(key, None)
+    def sync(self, db:Session):
+        # başka bir worker kullanıcı/rol değiştirdi (nesil arttı) -> tümünü düş
+        now=time.monotonic()
+        if now-self.checked<self.check_interval: return
+        self.checked=now
+        gen=db.execute(select(CacheGeneration.gen).where(CacheGeneration.name=="principals")).scalar_one_or_none()
+        if self.gen is not None and gen!=self.gen: self.invalidate()
+        self.gen=gen
+    def stats(self): return {"size":len(self._d),"maxsize":self.maxsize,"ttl":self.ttl,"hits":self.hits,"misses":self.misses}
+
+principals=PrincipalCache(float(os.getenv("PRINCIPAL_TTL","60")), int(os.getenv("PRINCIPAL_CACHE_SIZE","1024")), float(os.getenv("PRINCIPAL_GEN_CHECK","1.0")))
+
+def load_principal(db:Session, u_name:str)->Optional[Principal]:
+    # kullanıcı + rol adları tek sorguda
+    rows=db.execute(select(User.id, User.is_active, Role.name).select_from(User)
+        .outerjoin(user_roles, user_roles.c.user_id==User.id).outerjoin(Role, Role.id==user_roles.c.role_id)
+        .where(User.username==u_name)).all()
+    if not rows: return None
+    return Principal(rows[0][0], u_name, bool(rows[0][1]), frozenset(r[2] for r in rows if r[2]))
+
+def get_user(creds:HTTPAuthorizationCredentials=Depends(bearer), db:Session=Depends(get_db))->Principal:
     if not creds: raise HTTPException(401,"Auth required")
     try: u_name=decode_token(creds.credentials).get("sub")
     except Exception: raise HTTPException(401,"Invalid token")
-    u=db.execute(select(User).where(User.username==u_name)).scalar_one_or_none()
+    principals.sync(db)
+    u=principals.get(u_name)
+    if u is None:
+        epoch=principals.epoch; u=load_principal(db, u_name)
+        if u: principals.put(u_name, u, epoch)
     if not u or not u.is_active: raise HTTPException(401,"User inactive")
     return u
 def require_roles(*roles:str):
-    def inner(u:"User"=Depends(get_user)):
-        have={r.name for r in u.roles}
-        if not roles or (have & set(roles)): return u
+    def inner(u:Principal=Depends(get_user)):
+        if not roles or (u.roles & set(roles)): return u
         raise HTTPException(403,"Insufficient role")
     return inner
 
@@ -85,6 +172,10 @@ class Stock(Base):
     item_id=Column(Integer, ForeignKey("items.id"), nullable=False)
     warehouse_id=Column(Integer, ForeignKey("warehouses.id"), nullable=False)
     qty=Column(Float, default=0.0); avg_cost=Column(Float, default=0.0)
+    # optimistic kilit: UPDATE ... WHERE id=? AND version=?; tutmazsa StaleDataError -> retrying()
+    version=Column(Integer, nullable=False, default=1)
+    __table_args__=(UniqueConstraint("item_id","warehouse_id", name="uq_stock_item_wh"),)
+    __mapper_args__={"version_id_col": version}
 
 class StockMove(Base):
     __tablename__="stock_moves"
@@ -94,12 +185,46 @@ class StockMove(Base):
     wh_from=Column(Integer, ForeignKey("warehouses.id")); wh_to=Column(Integer, ForeignKey("warehouses.id"))
     qty=Column(Float, nullable=False); unit_price=Column(Float, default=0.0)
     move_type=Column(String, nullable=False); ref=Column(String)
+    # transfer bacaklarında iki depo da dolu; as-of replay ortalama maliyeti buna göre yürütür
+    __table_args__=(Index("ix_stock_moves_item_to_ts","item_id","wh_to","ts"), Index("ix_stock_moves_item_from_ts","item_id","wh_from","ts"))
+
+class CostLayer(Base):
+    # FIFO giriş katmanı; açık katmanlar (qty_left>0) kısmi indeksle taranır
+    __tablename__="cost_layers"
+    id=Column(Integer, primary_key=True); ts=Column(DateTime, default=datetime.utcnow)
+    item_id=Column(Integer, ForeignKey("items.id"), nullable=False); warehouse_id=Column(Integer, ForeignKey("warehouses.id"), nullable=False)
+    qty_in=Column(Float, nullable=False); qty_left=Column(Float, nullable=False); unit_cost=Column(Float, nullable=False)
+    __table_args__=(Index("ix_cost_layers_open","item_id","warehouse_id","id", sqlite_where=qty_left>0, postgresql_where=qty_left>0),)
+
+class StockCheckpoint(Base):
+    # ts öncesindeki (ts hariç) tüm hareketlerin bakiyesi; last_move_id'ye kadar işlendi
+    __tablename__="stock_checkpoints"
+    id=Column(Integer, primary_key=True); ts=Column(DateTime, unique=True, nullable=False); last_move_id=Column(Integer, nullable=False, default=0)
+
+class StockCheckpointLine(Base):
+    __tablename__="stock_checkpoint_lines"
+    checkpoint_id=Column(Integer, ForeignKey("stock_checkpoints.id", ondelete="CASCADE"), primary_key=True)
+    item_id=Column(Integer, ForeignKey("items.id"), primary_key=True); warehouse_id=Column(Integer, ForeignKey("warehouses.id"), primary_key=True)
+    qty=Column(Float, nullable=False); avg_cost=Column(Float, nullable=False)
+
+class LowStock(Base):
+    # şu an min_stock altında olanlar; warehouse_id=0 -> tüm depolar toplamı
+    __tablename__="low_stock"
+    item_id=Column(Integer, ForeignKey("items.id"), primary_key=True); warehouse_id=Column(Integer, primary_key=True)
+    qty=Column(Float, nullable=False); min_stock=Column(Float, nullable=False); since=Column(DateTime, default=datetime.utcnow)
+
+class LowStockEvent(Base):
+    # eşik geçiş akışı (BELOW / CLEARED); id imleç olarak kullanılır
+    __tablename__="low_stock_events"
+    id=Column(Integer, primary_key=True); ts=Column(DateTime, default=datetime.utcnow)
+    item_id=Column(Integer, nullable=False); warehouse_id=Column(Integer, nullable=False)
+    kind=Column(String, nullable=False); qty=Column(Float, nullable=False); min_stock=Column(Float, nullable=False)
 
 class Document(Base):
     __tablename__="documents"
     id=Column(Integer, primary_key=True)
     doc_type=Column(String, nullable=False); number=Column(String, unique=True, nullable=False)
-    date=Column(DateTime, default=datetime.utcnow); party_id=Column(Integer, ForeignKey("parties.id"), nullable=False)
+    date=Column(DateTime, default=datetime.utcnow, index=True); party_id=Column(Integer, ForeignKey("parties.id"), nullable=False)
     currency=Column(String, default="TRY"); notes=Column(Text)
     subtotal=Column(Float, default=0.0); vat_total=Column(Float, default=0.0); grand_total=Column(Float, default=0.0)
     status=Column(String, default="OPEN")
@@ -107,11 +232,19 @@ class Document(Base):
 class DocumentLine(Base):
     __tablename__="document_lines"
     id=Column(Integer, primary_key=True)
-    document_id=Column(Integer, ForeignKey("documents.id"), nullable=False)
+    document_id=Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
     item_id=Column(Integer, ForeignKey("items.id"), nullable=False)
     qty=Column(Float, nullable=False); unit_price=Column(Float, nullable=False)
     vat_rate=Column(Float, default=20.0); line_total=Column(Float, default=0.0)
 
+class DocumentLink(Base):
+    # dönüşüm izi: bir belge aynı hedef türe yalnızca bir kez dönüştürülür
+    __tablename__="document_links"
+    id=Column(Integer, primary_key=True)
+    src_id=Column(Integer, ForeignKey("documents.id"), nullable=False); dst_id=Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
+    dst_type=Column(String, nullable=False)
+    __table_args__=(UniqueConstraint("src_id","dst_type", name="uq_doc_link"),)
+
 class CashAccount(Base):
     __tablename__="cash_accounts"; id=Column(Integer, primary_key=True); name=Column(String, unique=True, nullable=False)
 
@@ -120,7 +253,7 @@ class BankAccount(Base):
 
 class CashBankTx(Base):
     __tablename__="cash_bank_tx"
-    id=Column(Integer, primary_key=True); date=Column(DateTime, default=datetime.utcnow)
+    id=Column(Integer, primary_key=True); date=Column(DateTime, default=datetime.utcnow, index=True)
     account_type=Column(String, nullable=False); account_id=Column(Integer, nullable=False)
     direction=Column(String, nullable=False); party_id=Column(Integer, ForeignKey("parties.id"))
     amount=Column(Float, nullable=False); currency=Column(String, default="TRY"); ref=Column(String); notes=Column(Text)
@@ -129,7 +262,22 @@ class Cheque(Base):
     __tablename__="cheques"
     id=Column(Integer, primary_key=True); number=Column(String, unique=True, nullable=False)
     party_id=Column(Integer, ForeignKey("parties.id")); amount=Column(Float, nullable=False)
-    currency=Column(String, default="TRY"); due_date=Column(DateTime, nullable=False); status=Column(String, default="PORTFOY"); notes=Column(Text)
+    currency=Column(String, default="TRY"); due_date=Column(DateTime, nullable=False, index=True); status=Column(String, default="PORTFOY"); notes=Column(Text)
+
+class PartyBalance(Base):
+    # cari özet: fatura/ödeme (OUT) borç, tahsilat (IN)/çek alacak; unapplied = açık kaleme düşülemeyen alacak
+    __tablename__="party_balances"
+    party_id=Column(Integer, ForeignKey("parties.id"), primary_key=True)
+    debit=Column(Float, nullable=False, default=0.0); credit=Column(Float, nullable=False, default=0.0)
+    unapplied=Column(Float, nullable=False, default=0.0); cheque_total=Column(Float, nullable=False, default=0.0)
+    updated_at=Column(DateTime, default=datetime.utcnow)
+
+class PartyOpenItem(Base):
+    # vadesi gelen/gelecek açık borç; alacaklar en eski vadeden düşülür, kapanan satır silinir
+    __tablename__="party_open_items"
+    id=Column(Integer, primary_key=True); party_id=Column(Integer, ForeignKey("parties.id"), nullable=False)
+    due_date=Column(DateTime, nullable=False); amount=Column(Float, nullable=False); amount_left=Column(Float, nullable=False)
+    __table_args__=(Index("ix_party_open_items_party_due","party_id","due_date"), Index("ix_party_open_items_due","due_date"))
 
 class WorkOrder(Base):
     __tablename__="work_orders"
@@ -140,9 +288,18 @@ class WorkOrder(Base):
 
 class WorkOrderConsumption(Base):
     __tablename__="wo_consumptions"
-    id=Column(Integer, primary_key=True); wo_id=Column(Integer, ForeignKey("work_orders.id"), nullable=False)
+    id=Column(Integer, primary_key=True); wo_id=Column(Integer, ForeignKey("work_orders.id"), nullable=False, index=True)
     item_id=Column(Integer, ForeignKey("items.id"), nullable=False); qty=Column(Float, nullable=False)
     wh_id=Column(Integer, ForeignKey("warehouses.id"), nullable=False); ref=Column(String)
+    unit_cost=Column(Float)  # tüketildiği depodaki maliyet; eski kayıtlarda NULL
+
+class BomLine(Base):
+    # reçete: 1 birim parent (Mamul) için component miktarı
+    __tablename__="bom_lines"
+    id=Column(Integer, primary_key=True)
+    parent_id=Column(Integer, ForeignKey("items.id"), nullable=False, index=True); component_id=Column(Integer, ForeignKey("items.id"), nullable=False)
+    qty=Column(Float, nullable=False)
+    __table_args__=(UniqueConstraint("parent_id","component_id", name="uq_bom_parent_component"),)
 
 class WorkOrderFG(Base):
     __tablename__="wo_fg"
@@ -150,6 +307,136 @@ class WorkOrderFG(Base):
     product_id=Column(Integer, ForeignKey("items.id"), nullable=False); qty=Column(Float, nullable=False)
     wh_id=Column(Integer, ForeignKey("warehouses.id"), nullable=False); unit_cost=Column(Float, default=0.0)
 
+@event.listens_for(SessionLocal, "after_flush")
+def _invalidate_principals(session, ctx):
+    # kullanıcı pasifleşti/rolleri değişti: düşülecekleri commit'e kadar biriktir (None: tümü),
+    # diğer worker'lar için nesli aynı transaction'da artır
+    stale={o.username if isinstance(o, User) else None for o in list(session.dirty)+list(session.deleted) if isinstance(o, (User, Role))}
+    if stale:
+        session.info.setdefault("principals_stale", set()).update(stale)
+        session.connection().execute(update(CacheGeneration).where(CacheGeneration.name=="principals").values(gen=CacheGeneration.gen+1))
+
+@event.listens_for(SessionLocal, "after_commit")
+def _drop_principals(session):
+    # commit'ten önce düşersek araya giren istek eski rolleri TTL boyunca geri yazar
+    for k in session.info.pop("principals_stale", ()): principals.invalidate(k)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _forget_principals(session): session.info.pop("principals_stale", None)
+
+@event.listens_for(SessionLocal, "after_flush")
+def _track_low_stock(session, ctx):
+    """Değişen stok satırlarından min_stock eşik geçişlerini low_stock / low_stock_events'e yazar.
+    Yalnızca bu flush'ta değişen (item, depo) satırlarına ve toplamlarına bakar."""
+    deltas={}
+    for o in list(session.new)+list(session.dirty):
+        if isinstance(o, Stock):
+            h=inspect(o).attrs.qty.history
+            if o in session.new: old=None  # yeni depo satırı: önceden izlenmiyordu
+            elif not h.has_changes(): continue
+            else: old=(h.deleted[0] if h.deleted else 0.0) or 0.0
+            if old!=(o.qty or 0.0): deltas[(o.item_id,o.warehouse_id)]=(old, o.qty or 0.0)
+    new_items={o.id:o.min_stock for o in session.new if isinstance(o, Item) and (o.min_stock or 0)>0}
+    if deltas or new_items: track_low_stock(session.connection(), deltas, new_items)
+
+def track_low_stock(con, deltas:dict, new_items:dict={}):
+    # deltas: (item, depo) -> (eski qty|None, yeni qty); ORM dışı (Core UPDATE) stok yazanlar da doğrudan çağırır
+    now=datetime.utcnow()
+    item_ids={i for i,_ in deltas}
+    mins=dict(con.execute(select(Item.id, Item.min_stock).where(Item.id.in_(item_ids), Item.min_stock>0)).all()) if item_ids else {}
+    changes=[((i,w),old,new,mins[i]) for (i,w),(old,new) in deltas.items() if i in mins]
+    if mins:
+        totals_now=dict(con.execute(select(Stock.item_id, func.sum(Stock.qty)).where(Stock.item_id.in_(list(mins))).group_by(Stock.item_id)).all())
+        for i,m in mins.items():
+            new=totals_now.get(i) or 0.0; old=new-sum(n-(o or 0.0) for (ii,_),(o,n) in deltas.items() if ii==i)
+            changes.append(((i,0),old,new,m))
+    changes+=[((i,0),m,0.0,m) for i,m in new_items.items()]  # yeni kart: stok yok
+    ins=[]; dels=[]; ups=[]; evs=[]
+    for (i,w),old,new,m in changes:
+        if old is None: old=m  # yeni satır eşiğin üstünden başlamış sayılır
+        if old>=m and new<m: ins.append(dict(item_id=i, warehouse_id=w, qty=new, min_stock=m, since=now)); evs.append(dict(ts=now, item_id=i, warehouse_id=w, kind="BELOW", qty=new, min_stock=m))
+        elif old<m and new>=m: dels.append((i,w)); evs.append(dict(ts=now, item_id=i, warehouse_id=w, kind="CLEARED", qty=new, min_stock=m))
+        elif new<m: ups.append(dict(k_item=i, k_wh=w, qty=new))
+    if ins: con.execute(insert(LowStock), ins)
+    for i,w in dels: con.execute(LowStock.__table__.delete().where(LowStock.item_id==i, LowStock.warehouse_id==w))
+    if ups:
+        t=LowStock.__table__
+        con.execute(t.update().where(t.c.item_id==bindparam("k_item"), t.c.warehouse_id==bindparam("k_wh")).values(qty=bindparam("qty")), ups)
+    if evs: con.execute(insert(LowStockEvent), evs)
+
+def rebuild_low_stock(con):
+    # tam yeniden hesap (göç ve onarım için); olay üretmez
+    con.execute(LowStock.__table__.delete())
+    con.execute(insert(LowStock).from_select(["item_id","warehouse_id","qty","min_stock","since"],
+        select(Stock.item_id, Stock.warehouse_id, Stock.qty, Item.min_stock, func.current_timestamp())
+        .join(Item, Item.id==Stock.item_id).where(Item.min_stock>0, Stock.qty<Item.min_stock)))
+    tot=func.coalesce(func.sum(Stock.qty),0.0)
+    con.execute(insert(LowStock).from_select(["item_id","warehouse_id","qty","min_stock","since"],
+        select(Item.id, literal(0), tot, Item.min_stock, func.current_timestamp()).outerjoin(Stock, Stock.item_id==Item.id)
+        .where(Item.min_stock>0).group_by(Item.id, Item.min_stock).having(tot<Item.min_stock)))
+
+class CacheGeneration(Base):
+    __tablename__="cache_generations"
+    name=Column(String, primary_key=True); gen=Column(Integer, nullable=False, default=0)
+
+class NumberSequence(Base):
+    __tablename__="number_sequences"
+    series=Column(String, primary_key=True); year=Column(String, primary_key=True); last=Column(Integer, nullable=False, default=0)
+
+ItemRef=namedtuple("ItemRef","id vat_rate unit type cost_method")
+
+class MasterCache:
+    """Ana veri kod -> id önbelleği (stok, depo, cari, kasa/banka hesabı).
+    Kayıtlar yalnızca eklendiğinden, cache_generations.gen değişince diğer
+    worker'lar bilinen en büyük id'den sonrasını çeker. Bilinmeyen kod DB'den okunur."""
+    KINDS={"item":(Item,"code",lambda r: ItemRef(r.id, r.vat_rate, r.unit, r.type, r.cost_method or "AVERAGE")),
+           "wh":(Warehouse,"code",lambda r: r.id), "party":(Party,"code",lambda r: r.id),
+           "CASH":(CashAccount,"name",lambda r: r.id), "BANK":(BankAccount,"name",lambda r: r.id)}
+    def __init__(self, check_interval:float=1.0):
+        self.maps={k:{} for k in self.KINDS}; self.max_id={k:0 for k in self.KINDS}
+        self.gen=None; self.checked=0.0; self.check_interval=check_interval; self._lock=threading.Lock()
+    def _load(self, db:Session, kind:str, *where):
+        model,key,ref=self.KINDS[kind]; t=model.__table__
+        for r in db.execute(select(t).where(*where)):
+            self.maps[kind][getattr(r,key)]=ref(r); self.max_id[kind]=max(self.max_id[kind], r.id)
+    def refresh(self, db:Session, force:bool=False):
+        now=time.monotonic()
+        if not force and now-self.checked<self.check_interval: return
+        with self._lock:
+            self.checked=now
+            gen=db.execute(select(CacheGeneration.gen).where(CacheGeneration.name=="master")).scalar_one_or_none()
+            gen=gen or 0  # satır migrate() ile açılır
+            if gen!=self.gen or force:
+                for k,(model,_,_) in self.KINDS.items(): self._load(db, k, model.id>self.max_id[k])
+                self.gen=gen
+    def get(self, db:Session, kind:str, code:Optional[str]):
+        if not code: return None
+        self.refresh(db)
+        v=self.maps[kind].get(code)
+        if v is None:
+            model,key,_=self.KINDS[kind]; self._load(db, kind, getattr(model,key)==code); v=self.maps[kind].get(code)
+        return v
+    def many(self, db:Session, kind:str, codes)->dict:
+        self.refresh(db)
+        m=self.maps[kind]; missing=[c for c in set(codes) if c and c not in m]
+        model,key,_=self.KINDS[kind]
+        for part in chunked(missing): self._load(db, kind, getattr(model,key).in_(part))
+        return {c:m[c] for c in set(codes) if c in m}
+    def touch(self, db:Session):
+        # yazan işlemle aynı transaction'da nesli artır
+        db.execute(update(CacheGeneration).where(CacheGeneration.name=="master").values(gen=CacheGeneration.gen+1))
+    def add(self, kind:str, obj):
+        # commit sonrası write-through
+        model,key,ref=self.KINDS[kind]; self.put(kind, getattr(obj,key), ref(obj))
+    def put(self, kind:str, code:str, val):
+        self.maps[kind][code]=val; self.max_id[kind]=max(self.max_id[kind], val if isinstance(val,int) else val.id)
+
+def chunked(seq, n:int=500):
+    seq=list(seq)
+    for i in range(0, len(seq), n): yield seq[i:i+n]
+
+master=MasterCache(float(os.getenv("MASTER_CACHE_CHECK","1.0")))
+
 # ---- Pydantic ----
 class Token(BaseModel): access_token:str; token_type:str="bearer"
 class RegisterIn(BaseModel): username:str; password:str; full_name:Optional[str]=None; email:Optional[str]=None; roles:List[str]=[]
@@ -169,20 +456,285 @@ class WOProduceIn(BaseModel): wo_id:int; qty:float; warehouse_code:str; overhead
 
 app=FastAPI(title="Fixar ERP/MES (TR, TL)")
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
-Base.metadata.create_all(bind=engine)
+
+# ---- Ölçüm: rota gecikme histogramları, istek başına SQL sayısı/süresi, yavaş istek profili ----
+# METRICS_NPLUS1: bu kadar sorgudan sonra uyarı; PROFILE_SLOW=1: örnekleyici profil, PROFILE_INTERVAL_MS, PROFILE_KEEP
+log=logging.getLogger("fixar")
+LATENCY_BUCKETS=(0.005,0.01,0.025,0.05,0.1,0.25,0.5,1.0,2.5,5.0,10.0)
+req_ctx=contextvars.ContextVar("req_ctx", default=None)
+
+class Metrics:
+    def __init__(self, nplus1:int=50):
+        self.nplus1=nplus1; self._lock=threading.Lock()
+        self.hist={}; self.status={}; self.sql={}; self.warn={}
+    def observe(self, method:str, route:str, status:int, dur:float, queries:int, sql_s:float):
+        with self._lock:
+            h=self.hist.setdefault((method,route), [[0]*len(LATENCY_BUCKETS), 0.0, 0])
+            for i,b in enumerate(LATENCY_BUCKETS):
+                if dur<=b: h[0][i]+=1
+            h[1]+=dur; h[2]+=1
+            k=(method,route,str(status)); self.status[k]=self.status.get(k,0)+1
+            q=self.sql.setdefault(route,[0,0.0]); q[0]+=queries; q[1]+=sql_s
+            if queries>=self.nplus1: self.warn[route]=self.warn.get(route,0)+1
+    def render(self)->str:
+        lab=lambda **kw: "{"+",".join(f'{k}="{v}"' for k,v in kw.items())+"}"
+        out=["# HELP fixar_request_duration_seconds Request latency per route","# TYPE fixar_request_duration_seconds histogram"]
+        with self._lock:
+            for (m,r),(b,sm,n) in sorted(self.hist.items()):
+                out+=[f"fixar_request_duration_seconds_bucket{lab(method=m,route=r,le=le)} {c}" for le,c in zip(LATENCY_BUCKETS,b)]
+                out+=[f"fixar_request_duration_seconds_bucket{lab(method=m,route=r,le='+Inf')} {n}",
+                      f"fixar_request_duration_seconds_sum{lab(method=m,route=r)} {sm:.6f}", f"fixar_request_duration_seconds_count{lab(method=m,route=r)} {n}"]
+            out+=["# TYPE fixar_requests_total counter"]+[f"fixar_requests_total{lab(method=m,route=r,status=s)} {n}" for (m,r,s),n in sorted(self.status.items())]
+            out+=["# TYPE fixar_sql_queries_total counter"]+[f"fixar_sql_queries_total{lab(route=r)} {q}" for r,(q,_) in sorted(self.sql.items())]
+            out+=["# TYPE fixar_sql_seconds_total counter"]+[f"fixar_sql_seconds_total{lab(route=r)} {t:.6f}" for r,(_,t) in sorted(self.sql.items())]
+            out+=["# TYPE fixar_nplus1_warnings_total counter"]+[f"fixar_nplus1_warnings_total{lab(route=r)} {n}" for r,n in sorted(self.warn.items())]
+        ps=principals.stats()
+        out+=["# TYPE fixar_principal_cache_hits_total counter", f"fixar_principal_cache_hits_total {ps['hits']}",
+              "# TYPE fixar_principal_cache_misses_total counter", f"fixar_principal_cache_misses_total {ps['misses']}"]
+        return "\n".join(out)+"\n"
+
+metrics=Metrics(int(os.getenv("METRICS_NPLUS1","50")))
+
+class SlowProfiler:
+    """Aktif isteklerin iş parçacıklarından (SQL çalıştıran thread'ler) periyodik yığın örneği alır;
+    en yavaş PROFILE_KEEP isteğin en sık yığınlarını saklar."""
+    def __init__(self, interval:float=0.005, keep:int=20):
+        self.interval=interval; self.keep=keep; self.active={}; self.slowest=[]; self._lock=threading.Lock(); self._t=None
+    def start(self):
+        if not self._t: self._t=threading.Thread(target=self._run, daemon=True, name="fixar-profiler"); self._t.start()
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock: ctxs=list(self.active.values())
+            if not ctxs: continue
+            frames=sys._current_frames()
+            for ctx in ctxs:
+                for tid in list(ctx["threads"]):
+                    f=frames.get(tid)
+                    if f: st="".join(traceback.format_stack(f, limit=25)); ctx["samples"][st]=ctx["samples"].get(st,0)+1
+    def begin(self, ctx):
+        with self._lock: self.active[ctx["id"]]=ctx
+    def end(self, ctx, route:str, dur:float):
+        with self._lock:
+            self.active.pop(ctx["id"], None)
+            if len(self.slowest)<self.keep or dur>self.slowest[0][0]:
+                top=sorted(ctx["samples"].items(), key=lambda x:-x[1])[:5]
+                heapq.heappush(self.slowest, (dur, ctx["id"], route, ctx["queries"], top))
+                if len(self.slowest)>self.keep: heapq.heappop(self.slowest)
+    def dump(self)->list:
+        with self._lock:
+            return [{"route":r,"duration_ms":round(d*1000,2),"queries":q,"stacks":[{"samples":n,"stack":st} for st,n in top]}
+                    for d,_,r,q,top in sorted(self.slowest, reverse=True)]
+
+profiler=SlowProfiler(float(os.getenv("PROFILE_INTERVAL_MS","5"))/1000, int(os.getenv("PROFILE_KEEP","20"))) if os.getenv("PROFILE_SLOW")=="1" else None
+
+def _sql_before(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("q_start",[]).append(time.perf_counter())
+def _sql_after(conn, cursor, statement, parameters, context, executemany):
+    t0=conn.info["q_start"].pop(); ctx=req_ctx.get()
+    if ctx is not None:
+        ctx["queries"]+=1; ctx["sql"]+=time.perf_counter()-t0; ctx["threads"].add(threading.get_ident())
+for _eng in (engine, read_engine):
+    event.listen(_eng, "before_cursor_execute", _sql_before); event.listen(_eng, "after_cursor_execute", _sql_after)
+
+_req_ids=itertools.count(1)
+@app.middleware("http")
+async def instrument(request:Request, call_next):
+    ctx={"id":next(_req_ids),"queries":0,"sql":0.0,"threads":{threading.get_ident()},"samples":{}}
+    token=req_ctx.set(ctx); t0=time.perf_counter()
+    if profiler: profiler.start(); profiler.begin(ctx)
+    status=500
+    try:
+        response=await call_next(request); status=response.status_code
+    finally:
+        dur=time.perf_counter()-t0; req_ctx.reset(token)
+        route=getattr(request.scope.get("route"), "path", "unmatched")
+        metrics.observe(request.method, route, status, dur, ctx["queries"], ctx["sql"])
+        if ctx["queries"]>=metrics.nplus1: log.warning("possible N+1: %s %s ran %d queries (%.1f ms SQL)", request.method, route, ctx["queries"], ctx["sql"]*1000)
+        if profiler: profiler.end(ctx, route, dur)
+    response.headers["Server-Timing"]=f'app;dur={dur*1000:.2f}, db;dur={ctx["sql"]*1000:.2f};desc="{ctx["queries"]} queries"'
+    return response
+# ---- Şema göçleri ----
+def _m_baseline(con):
+    Base.metadata.create_all(bind=con)
+    if not con.execute(select(CacheGeneration.name).where(CacheGeneration.name=="master")).first():
+        con.execute(insert(CacheGeneration).values(name="master", gen=0))
+
+def _m_stock_version(con):
+    # eski stocks tablosu: version kolonu + (item, depo) tekilliği; çift satırlar ağırlıklı ortalamayla birleştirilir
+    if "version" not in {c["name"] for c in inspect(con).get_columns("stocks")}:
+        con.exec_driver_sql("ALTER TABLE stocks ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+    dups=con.execute(select(Stock.item_id, Stock.warehouse_id).group_by(Stock.item_id, Stock.warehouse_id).having(func.count()>1)).all()
+    for item_id, wh_id in dups:
+        rows=con.execute(select(Stock.id, Stock.qty, Stock.avg_cost).where(Stock.item_id==item_id, Stock.warehouse_id==wh_id).order_by(Stock.id)).all()
+        qty=sum(r.qty or 0 for r in rows); val=sum((r.qty or 0)*(r.avg_cost or 0) for r in rows)
+        con.execute(update(Stock).where(Stock.id==rows[0].id).values(qty=qty, avg_cost=(val/qty) if qty else rows[0].avg_cost))
+        con.execute(Stock.__table__.delete().where(Stock.id.in_([r.id for r in rows[1:]])))
+    insp=inspect(con)
+    uniq=[u["column_names"] for u in insp.get_unique_constraints("stocks")]+[i["column_names"] for i in insp.get_indexes("stocks") if i["unique"]]
+    if ["item_id","warehouse_id"] not in uniq:
+        con.exec_driver_sql("CREATE UNIQUE INDEX uq_stock_item_wh_ix ON stocks (item_id, warehouse_id)")
+
+def _m_ledger_indexes(con):
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_document_lines_document_id ON document_lines (document_id)")
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_stock_moves_item_to_ts ON stock_moves (item_id, wh_to, ts)")
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_stock_moves_item_from_ts ON stock_moves (item_id, wh_from, ts)")
+
+def _m_wo_costing(con):
+    Base.metadata.create_all(bind=con, tables=[BomLine.__table__])
+    if "unit_cost" not in {c["name"] for c in inspect(con).get_columns("wo_consumptions")}:
+        con.exec_driver_sql("ALTER TABLE wo_consumptions ADD COLUMN unit_cost FLOAT")
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_wo_consumptions_wo_id ON wo_consumptions (wo_id)")
+
+def _m_low_stock(con):
+    Base.metadata.create_all(bind=con, tables=[LowStock.__table__, LowStockEvent.__table__]); rebuild_low_stock(con)
+
+def _m_party_ledger(con):
+    # tablolar + geçmişten tek seferlik doldurma (tarih sırasıyla)
+    Base.metadata.create_all(bind=con, tables=[PartyBalance.__table__, PartyOpenItem.__table__])
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_cheques_due_date ON cheques (due_date)")
+    if con.execute(select(func.count()).select_from(PartyBalance)).scalar(): return
+    ev=[(d,0,pid,amt) for pid,amt,d in con.execute(select(Document.party_id, Document.grand_total, Document.date).where(Document.doc_type=="INVOICE"))]
+    ev+=[(d,1 if dr=="IN" else 0,pid,amt) for pid,amt,d,dr in con.execute(select(CashBankTx.party_id, CashBankTx.amount, CashBankTx.date, CashBankTx.direction)
+         .where(CashBankTx.party_id.is_not(None), CashBankTx.direction.in_(("IN","OUT"))))]
+    # çekin alınış tarihi tutulmuyor; vade sırasıyla işlenir
+    ev+=[(d,2,pid,amt) for pid,amt,d in con.execute(select(Cheque.party_id, Cheque.amount, Cheque.due_date).where(Cheque.party_id.is_not(None)))]
+    for d,kind,pid,amt in sorted(ev, key=lambda e:(e[0] or datetime.min, e[1])):
+        if kind==0: post_party_debits(con, [(pid, amt or 0.0, d or datetime.utcnow())])
+        else: post_party_credit(con, pid, amt or 0.0, cheque=kind==2)
+
+def _m_export_indexes(con):
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_documents_date ON documents (date)")
+    con.exec_driver_sql("CREATE INDEX IF NOT EXISTS ix_cash_bank_tx_date ON cash_bank_tx (date)")
+
+def _m_principal_gen(con):
+    # worker'lar arası principal önbelleği geçersizleme nesli
+    if not con.execute(select(CacheGeneration.name).where(CacheGeneration.name=="principals")).first():
+        con.execute(insert(CacheGeneration).values(name="principals", gen=0))
+
+def _m_transfer_legs(con):
+    # eski TRANSFER: OUT (wh_to boş) ve hemen ardından IN (wh_from boş), aynı kalem/miktar/fiyat/ref, tek flush'ta yazılmış.
+    # Karşı depo iki bacağa da yazılır ki as-of replay transfer girişini alış gibi fiyatlamasın.
+    # Bağımsız bir OUT+IN eşleşirse IN'in maliyet etkisi kaybolur; bu yüzden iki bacağın ts farkı da 50 ms içinde olmalı.
+    m=StockMove.__table__; o,i=m.alias("o"),m.alias("i")
+    rows=con.execute(select(o.c.id, o.c.wh_from, i.c.wh_to, o.c.ts, i.c.ts.label("its")).join(i, i.c.id==o.c.id+1)
+        .where(o.c.move_type=="OUT", o.c.wh_from.is_not(None), o.c.wh_to.is_(None), i.c.move_type=="IN", i.c.wh_to.is_not(None), i.c.wh_from.is_(None),
+               i.c.item_id==o.c.item_id, i.c.qty==o.c.qty, i.c.unit_price.is_not_distinct_from(o.c.unit_price), i.c.ref.is_not_distinct_from(o.c.ref))).all()
+    pairs=[(oid,fr,to) for oid,fr,to,ots,its in rows if ots and its and timedelta(0)<=its-ots<=timedelta(milliseconds=50)]
+    if not pairs: return
+    for part in chunked(pairs):
+        con.execute(m.update().where(m.c.id==bindparam("b_id")).values(wh_to=bindparam("b_wh")), [{"b_id":oid,"b_wh":to} for oid,_,to in part])
+        con.execute(m.update().where(m.c.id==bindparam("b_id")).values(wh_from=bindparam("b_wh")), [{"b_id":oid+1,"b_wh":fr} for oid,fr,_ in part])
+    # eski kurala göre hesaplanmış checkpoint'ler geçersiz: POST /stock/checkpoints ile yeniden kurulur
+    con.execute(StockCheckpointLine.__table__.delete()); con.execute(StockCheckpoint.__table__.delete())
+
+def _m_cost_layers(con): Base.metadata.create_all(bind=con, tables=[CostLayer.__table__])
+
+MIGRATIONS=[(1,"baseline",_m_baseline),(2,"stock_version_unique",_m_stock_version),(3,"ledger_indexes",_m_ledger_indexes),
+            (4,"wo_costing",_m_wo_costing),(5,"cost_layers",_m_cost_layers),(6,"low_stock",_m_low_stock),(7,"party_ledger",_m_party_ledger),
+            (8,"export_indexes",_m_export_indexes),(9,"principal_generation",_m_principal_gen),
+            (10,"transfer_legs",_m_transfer_legs)]
+
+def _migration_lock(con):
+    # tüm göç döngüsü tek yazma kilidi altında; diğer süreçler kilit boşalana dek bekler
+    if con.dialect.name=="sqlite":
+        deadline=time.monotonic()+float(os.getenv("MIGRATE_LOCK_TIMEOUT","300"))
+        while True:
+            try: con.exec_driver_sql("BEGIN IMMEDIATE"); return
+            except OperationalError as e:
+                if "locked" not in str(e) or time.monotonic()>deadline: raise
+                con.rollback(); time.sleep(0.1)
+    elif con.dialect.name=="postgresql": con.exec_driver_sql("SELECT pg_advisory_xact_lock(7270010)")
+
+def migrate(eng=None)->list:
+    """Eksik göçleri sırayla uygular, schema_version'a yazar. Döngü tek transaction'da ve yazma kilidi
+    altında çalışır (SQLite: BEGIN IMMEDIATE, PostgreSQL: advisory lock): aynı anda başlayan worker'lar
+    sıraya girer, schema_version kilit alındıktan sonra okunur. Hata olursa hiçbir göç yazılmaz.
+    Göçler idempotenttir: yeni veritabanında baseline her şeyi kurar, diğerleri no-op olur."""
+    eng=eng or engine; done=[]
+    with eng.connect() as con:
+        _migration_lock(con)
+        con.exec_driver_sql("CREATE TABLE IF NOT EXISTS schema_version (version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP)")
+        have={r[0] for r in con.exec_driver_sql("SELECT version FROM schema_version")}
+        for ver,name,fn in MIGRATIONS:
+            if ver in have: continue
+            fn(con)
+            con.execute(text("INSERT INTO schema_version (version, name, applied_at) VALUES (:v, :n, :t)"), {"v":ver, "n":name, "t":datetime.utcnow()})
+            done.append(name)
+        con.commit()
+    return done
+
+@app.on_event("startup")
+def startup():
+    if os.getenv("DB_AUTO_MIGRATE","1")=="1": migrate()
+    db=ReadSessionLocal()
+    try: master.refresh(db, force=True)
+    finally: db.close()
 
 @app.get("/health")
 def health(): return {"status":"ok"}
 
-def next_number(db:Session, doc_type:str)->str:
-    prefix={"QUOTE":"Q","ORDER":"S","DISPATCH":"IR","INVOICE":"F"}.get(doc_type,"D")
-    year=datetime.utcnow().strftime("%y")
-    last=db.execute(select(Document).where(Document.doc_type==doc_type).order_by(desc(Document.id)).limit(1)).scalar_one_or_none()
-    n=0
-    if last:
-        try:n=int(last.number.split("-")[-1])
-        except:n=last.id
-    return f"{prefix}{year}-{n+1:06d}"
+class NumberAllocator:
+    """(seri, yıl) başına sayaç: tek UPDATE ... RETURNING ile artar, tarama yok.
+    block=1: sayaç çağıranın transaction'ında artar (boşluksuz).
+    block>1: süreç başına blok (hi/lo) ayrı kısa transaction'da ayrılır; kullanılmayan numaralar boşluk bırakır.
+    SQLite tek yazıcılı olduğundan take() çağıranın ilk yazmasından önce çağrılmalı."""
+    def __init__(self, block:int=1):
+        self.block=block; self._blocks={}; self._lock=threading.Lock()
+    def _bump(self, db:Session, series:str, year:str, n:int, seed)->int:
+        stmt=(update(NumberSequence).where(NumberSequence.series==series, NumberSequence.year==year)
+              .values(last=NumberSequence.last+n).returning(NumberSequence.last))
+        last=db.execute(stmt).scalar_one_or_none()
+        if last is None:
+            # ilk kullanım: mevcut numaralardan başlat (yılda bir kez)
+            try:
+                with db.begin_nested(): db.execute(insert(NumberSequence).values(series=series, year=year, last=seed(db)))
+            except IntegrityError: pass
+            last=db.execute(stmt).scalar_one()
+        return last
+    def take(self, db:Session, series:str, n:int=1, seed=lambda db:0)->list:
+        year=datetime.utcnow().strftime("%y")
+        if self.block<=1:
+            last=self._bump(db, series, year, n, seed); return list(range(last-n+1, last+1))
+        with self._lock:
+            nxt,hi=self._blocks.get((series,year),(1,0))
+            if hi-nxt+1<n:
+                size=max(self.block, n); bdb=SessionLocal()
+                try: hi=self._bump(bdb, series, year, size, seed); bdb.commit()
+                finally: bdb.close()
+                nxt=hi-size+1
+            self._blocks[(series,year)]=(nxt+n, hi)
+            return list(range(nxt, nxt+n))
+    def advance(self, db:Session, series:str, last:int):
+        # elle verilen seri biçimli numara: sayaç onun gerisinde kalmasın (çağıranın transaction'ında)
+        year=datetime.utcnow().strftime("%y")
+        db.execute(update(NumberSequence).where(NumberSequence.series==series, NumberSequence.year==year, NumberSequence.last<last).values(last=last))
+
+numbers=NumberAllocator(int(os.getenv("NUMBER_BLOCK","1")))
+
+def max_suffix(col, prefix:str):
+    def seed(db:Session)->int:
+        n=0
+        for (num,) in db.execute(select(col).where(col.like(prefix+"%"))):
+            try: n=max(n, int(num[len(prefix):]))
+            except ValueError: pass
+        return n
+    return seed
+
+DOC_PREFIX={"QUOTE":"Q","ORDER":"S","DISPATCH":"IR","INVOICE":"F"}
+def next_numbers(db:Session, doc_type:str, n:int=1, exclude=())->list:
+    # elle girilmiş seri biçimli numaralarla (kayıtlı ya da exclude) çakışanlar atlanır, yerine yenisi alınır
+    prefix=DOC_PREFIX.get(doc_type,"D"); pre=f"{prefix}{datetime.utcnow().strftime('%y')}-"; out=[]
+    while len(out)<n:
+        cand=[f"{pre}{k:06d}" for k in numbers.take(db, prefix, n-len(out), max_suffix(Document.number, pre))]
+        used=set(db.execute(select(Document.number).where(Document.number.in_(cand))).scalars())
+        out+=[c for c in cand if c not in used and c not in exclude]
+    return out
+def advance_numbers(db:Session, doc_type:str, nums):
+    prefix=DOC_PREFIX.get(doc_type,"D"); pre=f"{prefix}{datetime.utcnow().strftime('%y')}-"
+    ks=[int(x[len(pre):]) for x in nums if x and x.startswith(pre) and x[len(pre):].isdigit()]
+    if ks: numbers.advance(db, prefix, max(ks))
+def next_number(db:Session, doc_type:str)->str: return next_numbers(db, doc_type)[0]
 
 def totals(lines):
     st=sum(l['qty']*l['unit_price'] for l in lines)
@@ -211,139 +763,773 @@ def login(p:LoginIn, db:Session=Depends(get_db)):
     if not u or not verify_pw(p.password, u.hashed_password): raise HTTPException(401,"Invalid credentials")
     return {"access_token": make_token(u.username), "token_type":"bearer"}
 
+class UserUpdate(BaseModel): is_active:Optional[bool]=None; roles:Optional[List[str]]=None
+@app.put("/auth/users/{username}", response_model=UserOut)
+def update_user(username:str, p:UserUpdate, db:Session=Depends(get_db), user=Depends(require_roles("Admin"))):
+    u=db.execute(select(User).where(User.username==username)).scalar_one_or_none()
+    if not u: raise HTTPException(404,"user not found")
+    if p.is_active is not None: u.is_active=p.is_active
+    if p.roles is not None:
+        rs=[]
+        for rn in p.roles:
+            r=db.execute(select(Role).where(Role.name==rn)).scalar_one_or_none()
+            if not r: r=Role(name=rn); db.add(r)
+            rs.append(r)
+        u.roles=rs
+    db.commit(); db.refresh(u)
+    return UserOut(id=u.id, username=u.username, full_name=u.full_name, email=u.email, roles=[r.name for r in u.roles])
+
+@app.get("/auth/cache")
+def auth_cache_stats(user=Depends(require_roles("Admin"))): return principals.stats()
+
+# --- Ölçüm uçları ---
+@app.get("/metrics")
+def get_metrics():
+    """Prometheus metin formatı (kimlik doğrulamasız; scrape için iç ağda tutun)."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/metrics/slow")
+def slow_requests(user=Depends(require_roles("Admin"))):
+    if not profiler: raise HTTPException(404, "Profil kapalı (PROFILE_SLOW=1)")
+    return profiler.dump()
+
 # --- Masters ---
 @app.post("/warehouses/")
 def create_wh(p:WarehouseIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin"))):
     if db.execute(select(Warehouse).where(Warehouse.code==p.code)).scalar_one_or_none(): raise HTTPException(400,"exists")
-    wh=Warehouse(code=p.code, name=p.name); db.add(wh); db.commit(); return {"id":wh.id}
+    wh=Warehouse(code=p.code, name=p.name); db.add(wh); master.touch(db); db.commit(); master.add("wh", wh); return {"id":wh.id}
 
 @app.post("/items/")
 def create_item(p:ItemIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Depo"))):
     if db.execute(select(Item).where(Item.code==p.code)).scalar_one_or_none(): raise HTTPException(400,"exists")
-    it=Item(**p.model_dump()); db.add(it); db.commit(); return {"id":it.id}
+    if p.cost_method not in ("AVERAGE","FIFO"): raise HTTPException(400,"invalid cost_method")
+    it=Item(**p.model_dump()); db.add(it); master.touch(db); db.commit(); master.add("item", it); return {"id":it.id}
 
 @app.post("/parties/")
 def create_party(p:PartyIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Muhasebe","Satis"))):
     if db.execute(select(Party).where(Party.code==p.code)).scalar_one_or_none(): raise HTTPException(400,"exists")
-    pr=Party(**p.model_dump()); db.add(pr); db.commit(); return {"id":pr.id}
+    pr=Party(**p.model_dump()); db.add(pr); master.touch(db); db.commit(); master.add("party", pr); return {"id":pr.id}
 
 # --- Stock ---
-@app.post("/stock/move")
-def stock_move(p:StockMoveIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Depo"))):
-    it=db.execute(select(Item).where(Item.code==p.item_code)).scalar_one_or_none()
-    if not it: raise HTTPException(400,"item not found")
-    wh_from=db.execute(select(Warehouse).where(Warehouse.code==p.wh_from_code)).scalar_one_or_none() if p.wh_from_code else None
-    wh_to=db.execute(select(Warehouse).where(Warehouse.code==p.wh_to_code)).scalar_one_or_none() if p.wh_to_code else None
+def get_stock(db:Session, cache:dict, item_id:int, wh_id:int, create:bool=False):
+    # cache: (item_id, wh_id) -> Stock; toplu işlemlerde önceden doldurulur
+    key=(item_id, wh_id)
+    if key not in cache: cache[key]=db.query(Stock).filter_by(item_id=item_id, warehouse_id=wh_id).one_or_none()
+    if cache[key] is None and create:
+        cache[key]=Stock(item_id=item_id, warehouse_id=wh_id, qty=0.0, avg_cost=0.0); db.add(cache[key])
+    return cache[key]
+
+def lock_stock(db:Session, item_ids, wh_ids):
+    # ORM yolu (FIFO, toplu hareket, üretim) okumadan önce stok satırlarına dokunur: yazma kilidi (SQLite) /
+    # satır kilidi (PostgreSQL) okumalardan önce alınır, eşzamanlı yazanlar sıraya girer ve version çakışması olmaz
+    wh_ids=[w for w in wh_ids if w]
+    if item_ids and wh_ids: db.execute(update(Stock).where(Stock.item_id.in_(list(item_ids)), Stock.warehouse_id.in_(wh_ids)).values(version=Stock.version+1))
+
+def fifo_layers(db:Session, cache:dict, item_id:int, wh_id:int)->list:
+    # açık katmanlar, eskiden yeniye; çağrı boyunca bellekte tutulur (toplu hareketlerde tek okuma)
+    key=("layers", item_id, wh_id)
+    if key not in cache:
+        cache[key]=db.execute(select(CostLayer).where(CostLayer.item_id==item_id, CostLayer.warehouse_id==wh_id, CostLayer.qty_left>0)
+                              .order_by(CostLayer.id)).scalars().all()
+    return cache[key]
+
+def fifo_receive(db:Session, cache:dict, item_id:int, wh_id:int, qty:float, unit_cost:float):
+    # yeni katman oturuma eklenmez (SQLite'ta ORM her satırı ayrı INSERT eder); write_layers() sonda tek seferde yazar
+    if qty<=0: return
+    l=CostLayer(item_id=item_id, warehouse_id=wh_id, qty_in=qty, qty_left=qty, unit_cost=unit_cost)
+    fifo_layers(db, cache, item_id, wh_id).append(l); cache.setdefault("new_layers",[]).append(l)
+
+def write_layers(db:Session, cache:dict):
+    """Çağrıda açılan katmanları (aynı çağrıdaki çıkışlardan sonraki qty_left ile) tek executemany ile yazar."""
+    new=cache.pop("new_layers",[])
+    if new: db.execute(insert(CostLayer), [dict(item_id=l.item_id, warehouse_id=l.warehouse_id, qty_in=l.qty_in, qty_left=l.qty_left, unit_cost=l.unit_cost) for l in new])
+
+def fifo_issue(db:Session, cache:dict, item_id:int, wh_id:int, qty:float, fallback_cost:float)->list:
+    """En eski katmanlardan qty düşer; [(miktar, birim maliyet)] döner. Yalnızca boşaltılan katmanlara dokunur.
+    Katmanlar yetmezse (FIFO'ya sonradan geçilen stok) kalan fallback_cost ile fiyatlanır."""
+    layers=fifo_layers(db, cache, item_id, wh_id); pieces=[]
+    while qty>1e-9 and layers:
+        l=layers[0]; q=min(qty, l.qty_left)
+        l.qty_left-=q; qty-=q; pieces.append((q, l.unit_cost))
+        if l.qty_left<=1e-9: l.qty_left=0.0; layers.pop(0)
+    if qty>1e-9: pieces.append((qty, fallback_cost))
+    return pieces
+
+def pieces_cost(pieces)->float: return sum(q*c for q,c in pieces)
+
+def apply_move(db:Session, cache:dict, it:ItemRef, wh_from_id, wh_to_id, p:StockMoveIn)->list:
+    """Hareketi stok satırlarına uygular, eklenecek StockMove kayıtlarını döner.
+    Tüm kontroller değişiklikten önce yapılır; hata olursa hiçbir şey değişmez.
+    cost_method=FIFO kalemlerde ayrıca maliyet katmanları yürütülür."""
+    it_id=it.id; fifo=it.cost_method=="FIFO"
     if p.move_type=="IN":
-        if not wh_to: raise HTTPException(400,"IN requires wh_to")
-        st=db.query(Stock).filter_by(item_id=it.id, warehouse_id=wh_to.id).one_or_none()
-        if not st: st=Stock(item_id=it.id, warehouse_id=wh_to.id, qty=0.0, avg_cost=0.0); db.add(st)
+        if not wh_to_id: raise HTTPException(400,"IN requires wh_to")
+        st=get_stock(db, cache, it_id, wh_to_id, create=True)
         total=st.avg_cost*st.qty + p.unit_price*p.qty
         st.qty += p.qty; st.avg_cost=(total/st.qty) if st.qty else 0.0
-        db.add(StockMove(item_id=it.id, wh_to=wh_to.id, qty=p.qty, unit_price=p.unit_price, move_type="IN", ref=p.ref))
+        if fifo: fifo_receive(db, cache, it_id, wh_to_id, p.qty, p.unit_price)
+        return [dict(item_id=it_id, wh_from=None, wh_to=wh_to_id, qty=p.qty, unit_price=p.unit_price, move_type="IN", ref=p.ref)]
     elif p.move_type=="OUT":
-        if not wh_from: raise HTTPException(400,"OUT requires wh_from")
-        st=db.query(Stock).filter_by(item_id=it.id, warehouse_id=wh_from.id).one_or_none()
+        if not wh_from_id: raise HTTPException(400,"OUT requires wh_from")
+        st=get_stock(db, cache, it_id, wh_from_id)
         if not st or st.qty < p.qty: raise HTTPException(400,"insufficient")
         st.qty -= p.qty
-        db.add(StockMove(item_id=it.id, wh_from=wh_from.id, qty=p.qty, unit_price=p.unit_price, move_type="OUT", ref=p.ref))
+        if fifo: fifo_issue(db, cache, it_id, wh_from_id, p.qty, st.avg_cost)
+        return [dict(item_id=it_id, wh_from=wh_from_id, wh_to=None, qty=p.qty, unit_price=p.unit_price, move_type="OUT", ref=p.ref)]
     elif p.move_type=="TRANSFER":
-        if not (wh_from and wh_to): raise HTTPException(400,"TRANSFER needs both warehouses")
-        st=db.query(Stock).filter_by(item_id=it.id, warehouse_id=wh_from.id).one_or_none()
+        if not (wh_from_id and wh_to_id): raise HTTPException(400,"TRANSFER needs both warehouses")
+        st=get_stock(db, cache, it_id, wh_from_id)
         if not st or st.qty < p.qty: raise HTTPException(400,"insufficient")
-        st.qty -= p.qty; db.add(StockMove(item_id=it.id, wh_from=wh_from.id, qty=p.qty, unit_price=p.unit_price, move_type="OUT", ref=p.ref))
-        st2=db.query(Stock).filter_by(item_id=it.id, warehouse_id=wh_to.id).one_or_none()
-        if not st2: st2=Stock(item_id=it.id, warehouse_id=wh_to.id, qty=0.0, avg_cost=0.0); db.add(st2)
-        st2.qty += p.qty; db.add(StockMove(item_id=it.id, wh_to=wh_to.id, qty=p.qty, unit_price=p.unit_price, move_type="IN", ref=p.ref))
+        st.qty -= p.qty
+        st2=get_stock(db, cache, it_id, wh_to_id, create=True); st2.qty += p.qty
+        if fifo:
+            # katmanlar maliyetleriyle hedef depoya taşınır
+            for q,c in fifo_issue(db, cache, it_id, wh_from_id, p.qty, st.avg_cost): fifo_receive(db, cache, it_id, wh_to_id, q, c)
+        return [dict(item_id=it_id, wh_from=wh_from_id, wh_to=wh_to_id, qty=p.qty, unit_price=p.unit_price, move_type="OUT", ref=p.ref),
+                dict(item_id=it_id, wh_from=wh_from_id, wh_to=wh_to_id, qty=p.qty, unit_price=p.unit_price, move_type="IN", ref=p.ref)]
+    raise HTTPException(400,"invalid move_type")
+
+# Ortalama maliyetli kalemler: stok satırı okunmadan tek koşullu UPDATE ile yazılır (yarışta version çakışması yok).
+# version yine artar ki ORM yolundan (FIFO, toplu hareket) yazanlar çakışmayı görsün. low_stock çağıran tarafından güncellenir.
+def take_stock(db:Session, item_id:int, wh_id:int, qty:float)->Optional[tuple]:
+    # çıkış: qty>=:q koşulu; yetmezse None, yoksa (eski, yeni, avg_cost)
+    r=db.execute(update(Stock).where(Stock.item_id==item_id, Stock.warehouse_id==wh_id, Stock.qty>=qty)
+                 .values(qty=Stock.qty-qty, version=Stock.version+1).returning(Stock.qty, Stock.avg_cost)).first()
+    return (r.qty+qty, r.qty, r.avg_cost) if r else None
+
+def put_stock(db:Session, item_id:int, wh_id:int, qty:float, unit_cost:Optional[float]=None)->tuple:
+    # giriş: unit_cost verilirse ağırlıklı ortalama SQL'de; satır yoksa açılır (yarışta unique -> retrying). (eski|None, yeni)
+    vals=dict(qty=Stock.qty+qty, version=Stock.version+1)
+    if unit_cost is not None: vals["avg_cost"]=case((Stock.qty+qty!=0, (Stock.avg_cost*Stock.qty+unit_cost*qty)/(Stock.qty+qty)), else_=0.0)
+    r=db.execute(update(Stock).where(Stock.item_id==item_id, Stock.warehouse_id==wh_id).values(**vals).returning(Stock.qty)).first()
+    if r: return (r.qty-qty, r.qty)
+    db.execute(insert(Stock).values(item_id=item_id, warehouse_id=wh_id, qty=qty, avg_cost=unit_cost or 0.0, version=1))
+    return (None, qty)
+
+def move_atomic(db:Session, it:ItemRef, wh_from_id, wh_to_id, p:StockMoveIn)->list:
+    """apply_move'un ortalama maliyetli kalemler için koşullu UPDATE'li karşılığı; aynı kurallar, aynı StockMove kayıtları."""
+    d={}
+    def note(wh, r): d[(it.id,wh)]=(d[(it.id,wh)][0] if (it.id,wh) in d else r[0], r[1])
+    if p.move_type=="IN":
+        if not wh_to_id: raise HTTPException(400,"IN requires wh_to")
+        note(wh_to_id, put_stock(db, it.id, wh_to_id, p.qty, p.unit_price))
+        ms=[dict(item_id=it.id, wh_from=None, wh_to=wh_to_id, qty=p.qty, unit_price=p.unit_price, move_type="IN", ref=p.ref)]
+    elif p.move_type in ("OUT","TRANSFER"):
+        if p.move_type=="OUT" and not wh_from_id: raise HTTPException(400,"OUT requires wh_from")
+        if p.move_type=="TRANSFER" and not (wh_from_id and wh_to_id): raise HTTPException(400,"TRANSFER needs both warehouses")
+        r=take_stock(db, it.id, wh_from_id, p.qty)
+        if r is None: raise HTTPException(400,"insufficient")
+        note(wh_from_id, r)
+        if p.move_type=="OUT": ms=[dict(item_id=it.id, wh_from=wh_from_id, wh_to=None, qty=p.qty, unit_price=p.unit_price, move_type="OUT", ref=p.ref)]
+        else:
+            note(wh_to_id, put_stock(db, it.id, wh_to_id, p.qty))
+            ms=[dict(item_id=it.id, wh_from=wh_from_id, wh_to=wh_to_id, qty=p.qty, unit_price=p.unit_price, move_type=t, ref=p.ref) for t in ("OUT","IN")]
     else: raise HTTPException(400,"invalid move_type")
-    db.commit(); return {"ok":True}
+    track_low_stock(db.connection(), d)
+    return ms
+
+STOCK_RETRIES=int(os.getenv("STOCK_RETRIES","8"))
+def retrying(db:Session, fn):
+    """fn() + commit; başka bir worker aynı satırı değiştirdiyse (version/unique çakışması,
+    SQLite kilidi) geri alıp baştan dener. fn her denemede stok satırlarını yeniden okumalı."""
+    for attempt in range(STOCK_RETRIES):
+        try:
+            r=fn(); db.commit(); return r
+        except (StaleDataError, IntegrityError, OperationalError) as e:
+            db.rollback()
+            if isinstance(e, OperationalError) and "locked" not in str(e): raise
+            # tam jitter: çakışanlar aynı anda yeniden denemesin; son denemeden sonra beklenmez
+            if attempt<STOCK_RETRIES-1: time.sleep(random.uniform(0, 0.005*2**attempt))
+    raise HTTPException(409,"update conflict, retry")
+
+@app.post("/stock/move")
+def stock_move(p:StockMoveIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Depo"))):
+    it=master.get(db, "item", p.item_code)
+    if not it: raise HTTPException(400,"item not found")
+    wh_from, wh_to=master.get(db, "wh", p.wh_from_code), master.get(db, "wh", p.wh_to_code)
+    def run():
+        if it.cost_method=="FIFO": lock_stock(db, [it.id], [wh_from, wh_to]); cache={}; ms=apply_move(db, cache, it, wh_from, wh_to, p); write_layers(db, cache)
+        else: ms=move_atomic(db, it, wh_from, wh_to, p)
+        for m in ms: db.add(StockMove(**m))
+        return {"ok":True}
+    return retrying(db, run)
+
+async def json_rows(request:Request)->list:
+    # Gövde: JSON dizi ya da NDJSON (satır başına bir nesne)
+    raw=(await request.body()).decode("utf-8-sig").strip()
+    try:
+        if raw.startswith("["): return json.loads(raw)
+        return [json.loads(l) for l in raw.splitlines() if l.strip()]
+    except ValueError: raise HTTPException(400,"invalid JSON/NDJSON body")
+
+@app.post("/stock/moves/batch")
+def stock_move_batch(rows:list=Depends(json_rows), skip_invalid:bool=False, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Depo"))):
+    """Toplu stok hareketi: kodlar ve stok satırları bir kez okunur, tek commit.
+    skip_invalid=false: herhangi bir satır hatalıysa hiçbir şey yazılmaz (400).
+    skip_invalid=true: hatalı satırlar atlanır, geçerliler işlenir."""
+    moves=[]; results=[]
+    for i,r in enumerate(rows):
+        try: moves.append((i, StockMoveIn.model_validate(r)))
+        except Exception as e: results.append({"line":i,"ok":False,"error":"invalid line: "+str(e).splitlines()[0]})
+    items=master.many(db, "item", [m.item_code for _,m in moves])
+    whs=master.many(db, "wh", [c for _,m in moves for c in (m.wh_from_code, m.wh_to_code) if c])
+    def run():
+        cache={}; res=list(results)
+        if items and whs:
+            for part in chunked([r.id for r in items.values()]):
+                lock_stock(db, part, list(whs.values()))
+                for st in db.execute(select(Stock).where(Stock.item_id.in_(part), Stock.warehouse_id.in_(list(whs.values())))).scalars():
+                    cache[(st.item_id, st.warehouse_id)]=st
+            for _,m in moves:
+                for c in (m.wh_from_code, m.wh_to_code):
+                    if m.item_code in items and c in whs: cache.setdefault((items[m.item_code].id, whs[c]), None)
+        new_moves=[]
+        for i,m in moves:
+            try:
+                it=items.get(m.item_code)
+                if not it: raise HTTPException(400,"item not found")
+                for c in (m.wh_from_code, m.wh_to_code):
+                    if c and c not in whs: raise HTTPException(400,"warehouse not found")
+                new_moves += apply_move(db, cache, it, whs.get(m.wh_from_code), whs.get(m.wh_to_code), m)
+                res.append({"line":i,"ok":True})
+            except HTTPException as e: res.append({"line":i,"ok":False,"error":e.detail})
+        res.sort(key=lambda r:r["line"])
+        failed=sum(1 for r in res if not r["ok"])
+        if failed and not skip_invalid:
+            db.rollback(); raise HTTPException(400, {"applied":0,"failed":failed,"results":res})
+        if new_moves: db.execute(insert(StockMove), new_moves)
+        write_layers(db, cache)
+        return {"applied":len(res)-failed,"failed":failed,"results":res}
+    return retrying(db, run)
+
+def stream_rows(stmt, fmt:str, cols:list, batch:int=1000, gzip:bool=False, filename:Optional[str]=None):
+    """Sorgu sonucunu sunucu taraflı imleçle NDJSON/CSV olarak akıtır; bellek sabit kalır.
+    Kendi oturumunu açar: yield'li bağımlılıklar yanıt akmadan kapanır.
+    gzip=True: her parti sonunda sync-flush'lı gzip akışı (ilk bayt beklemeden gider)."""
+    def rows():
+        db=ReadSessionLocal()
+        try:
+            res=db.execute(stmt.execution_options(stream_results=True, yield_per=batch))
+            if fmt=="csv":
+                buf=io.StringIO(); w=csv.writer(buf); w.writerow(cols); yield buf.getvalue(); buf.seek(0); buf.truncate()
+                for part in res.partitions():
+                    w.writerows(part); yield buf.getvalue(); buf.seek(0); buf.truncate()
+            else:
+                for part in res.partitions():
+                    yield "".join(json.dumps(dict(zip(cols,r)), default=str)+"\n" for r in part)
+        finally: db.close()
+    def gz():
+        z=zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in rows(): yield z.compress(chunk.encode()) + z.flush(zlib.Z_SYNC_FLUSH)
+        yield z.flush()
+    media="text/csv" if fmt=="csv" else "application/x-ndjson"
+    headers={}
+    if filename: headers["Content-Disposition"]=f'attachment; filename="{filename}{".gz" if gzip else ""}"'
+    return StreamingResponse(gz() if gzip else rows(), media_type="application/gzip" if gzip else media, headers=headers)
+
+SNAPSHOT_COLS=["id","item_code","warehouse_code","qty","avg_cost"]
+def snapshot_stmt(after_id:int=0, warehouse_code:Optional[str]=None, item_type:Optional[str]=None, in_stock:bool=False):
+    q=(select(Stock.id, Item.code, Warehouse.code, Stock.qty, Stock.avg_cost)
+       .join(Item, Item.id==Stock.item_id).join(Warehouse, Warehouse.id==Stock.warehouse_id)
+       .where(Stock.id>after_id).order_by(Stock.id))
+    if warehouse_code: q=q.where(Warehouse.code==warehouse_code)
+    if item_type: q=q.where(Item.type==item_type)
+    if in_stock: q=q.where(Stock.qty>0)
+    return q
 
 @app.get("/stock/snapshot")
-def snapshot(db:Session=Depends(get_db), user=Depends(require_roles("Admin","Depo","Muhasebe"))):
-    out=[]
-    for r in db.query(Stock).all():
-        item=db.get(Item,r.item_id); wh=db.get(Warehouse,r.warehouse_id)
-        out.append({"item_code":item.code,"warehouse_code":wh.code,"qty":r.qty,"avg_cost":r.avg_cost})
+def snapshot(response:Response, after_id:int=0, limit:Optional[int]=None, warehouse_code:Optional[str]=None, item_type:Optional[str]=None,
+             in_stock:bool=False, format:str="json", db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Depo","Muhasebe"))):
+    """Tek JOIN'li sorgu; stocks.id üzerinde keyset sayfalama (after_id + limit).
+    Sonraki sayfa imleci X-Next-Cursor başlığında döner. format=ndjson|csv tüm sonucu akıtır."""
+    q=snapshot_stmt(after_id, warehouse_code, item_type, in_stock)
+    if limit: q=q.limit(limit)
+    if format in ("ndjson","csv"): return stream_rows(q, format, SNAPSHOT_COLS)
+    out=[dict(zip(SNAPSHOT_COLS,r)) for r in db.execute(q)]
+    if limit and len(out)==limit: response.headers["X-Next-Cursor"]=str(out[-1]["id"])
+    return out
+
+def replay(bal:dict, moves)->int:
+    """Hareketleri (item,wh)->[qty,avg_cost] bakiyesine stock_move kurallarıyla uygular; son move id'yi döner.
+    Transfer girişleri (wh_from dolu IN) ortalama maliyeti değiştirmez; eski kayıtlardaki
+    wh_from'suz transfer bacakları göç 10 (transfer_legs) ile tamamlanır."""
+    last=0
+    for mid,item_id,wh_from,wh_to,qty,price,mtype in moves:
+        last=mid
+        if mtype=="IN" and wh_to:
+            b=bal.setdefault((item_id,wh_to),[0.0,0.0])
+            if wh_from: b[0]+=qty
+            else:
+                total=b[1]*b[0]+price*qty; b[0]+=qty; b[1]=(total/b[0]) if b[0] else 0.0
+        elif mtype=="OUT" and wh_from:
+            bal.setdefault((item_id,wh_from),[0.0,0.0])[0]-=qty
+    return last
+
+def move_rows(db:Session, after_id:int, before, item_id=None, wh_id=None):
+    q=(select(StockMove.id, StockMove.item_id, StockMove.wh_from, StockMove.wh_to, StockMove.qty, StockMove.unit_price, StockMove.move_type)
+       .where(StockMove.id>after_id, StockMove.ts<before).order_by(StockMove.id))
+    if item_id: q=q.where(StockMove.item_id==item_id)
+    if wh_id: q=q.where(or_(StockMove.wh_from==wh_id, StockMove.wh_to==wh_id))
+    return db.execute(q.execution_options(yield_per=5000))
+
+def code_map(db:Session, model, ids)->dict:
+    # id -> code, yalnızca istenen satırlar için (tüm önbelleği taramadan)
+    out={}
+    for part in chunked(set(ids)): out.update(db.execute(select(model.id, model.code).where(model.id.in_(part))).all())
     return out
 
+def month_starts(start:datetime, until:datetime):
+    d=datetime(start.year, start.month, 1)
+    while True:
+        d=datetime(d.year+(d.month==12), d.month%12+1, 1)
+        if d>until: return
+        yield d
+
+@app.post("/stock/checkpoints")
+def build_checkpoints(until:Optional[datetime]=None, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Muhasebe"))):
+    """Son checkpoint'ten until'e (varsayılan: bu ayın başı) kadar her ay başı için bakiye yazar.
+    Yalnızca son checkpoint'ten sonra eklenen hareketler işlenir."""
+    until=until or datetime.utcnow().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    cp=db.execute(select(StockCheckpoint).order_by(desc(StockCheckpoint.ts)).limit(1)).scalar_one_or_none()
+    bal={}; last_id=0
+    if cp:
+        start=cp.ts; last_id=cp.last_move_id
+        for r in db.execute(select(StockCheckpointLine).where(StockCheckpointLine.checkpoint_id==cp.id)).scalars(): bal[(r.item_id,r.warehouse_id)]=[r.qty,r.avg_cost]
+    else:
+        start=db.execute(select(func.min(StockMove.ts))).scalar()
+        if not start: return {"created":[]}
+    created=[]
+    for ts in month_starts(start, until):
+        last_id=replay(bal, move_rows(db, last_id, ts)) or last_id
+        new=StockCheckpoint(ts=ts, last_move_id=last_id); db.add(new); db.flush()
+        rows=[dict(checkpoint_id=new.id, item_id=i, warehouse_id=w, qty=q, avg_cost=a) for (i,w),(q,a) in bal.items() if q]
+        for part in chunked(rows, 5000): db.execute(insert(StockCheckpointLine), part)
+        db.commit(); created.append({"ts":ts,"last_move_id":last_id,"rows":len(rows)})
+    return {"created":created}
+
+@app.get("/stock/as-of")
+def stock_as_of(date:datetime, warehouse_code:Optional[str]=None, item_code:Optional[str]=None,
+                db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Depo","Muhasebe"))):
+    """date anındaki (hariç) bakiye: en yakın önceki checkpoint + sonrasındaki hareketler."""
+    item=master.get(db, "item", item_code) if item_code else None
+    wh_id=master.get(db, "wh", warehouse_code) if warehouse_code else None
+    if (item_code and not item) or (warehouse_code and not wh_id): raise HTTPException(400,"item/warehouse not found")
+    cp=db.execute(select(StockCheckpoint).where(StockCheckpoint.ts<=date).order_by(desc(StockCheckpoint.ts)).limit(1)).scalar_one_or_none()
+    bal={}
+    if cp:
+        q=select(StockCheckpointLine).where(StockCheckpointLine.checkpoint_id==cp.id)
+        if item: q=q.where(StockCheckpointLine.item_id==item.id)
+        if wh_id: q=q.where(StockCheckpointLine.warehouse_id==wh_id)
+        for r in db.execute(q).scalars(): bal[(r.item_id,r.warehouse_id)]=[r.qty,r.avg_cost]
+    replay(bal, move_rows(db, cp.last_move_id if cp else 0, date, item.id if item else None, wh_id))
+    rows=[(i,w,q,a) for (i,w),(q,a) in sorted(bal.items()) if q and (not wh_id or w==wh_id)]
+    icodes=code_map(db, Item, [r[0] for r in rows]); codes=code_map(db, Warehouse, [r[1] for r in rows])
+    return {"date":date,"checkpoint":cp.ts if cp else None,
+            "rows":[{"item_code":icodes.get(i),"warehouse_code":codes.get(w),"qty":q,"avg_cost":a} for i,w,q,a in rows]}
+
+@app.get("/stock/valuation")
+def stock_valuation(warehouse_code:Optional[str]=None, only_fifo:bool=False, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Muhasebe"))):
+    """Stok değerleme: açık katmanlar tek GROUP BY ile bir kez taranır. FIFO kalemde değer = katman değeri
+    (+ katmansız kalan miktar x avg_cost); AVERAGE kalemde qty x avg_cost."""
+    lay=(select(CostLayer.item_id, CostLayer.warehouse_id, func.sum(CostLayer.qty_left).label("lq"), func.sum(CostLayer.qty_left*CostLayer.unit_cost).label("lv"))
+         .where(CostLayer.qty_left>0).group_by(CostLayer.item_id, CostLayer.warehouse_id).subquery())
+    q=(select(Item.code, Warehouse.code, Item.cost_method, Stock.qty, Stock.avg_cost, func.coalesce(lay.c.lq,0.0), func.coalesce(lay.c.lv,0.0))
+       .join(Item, Item.id==Stock.item_id).join(Warehouse, Warehouse.id==Stock.warehouse_id)
+       .outerjoin(lay, (lay.c.item_id==Stock.item_id) & (lay.c.warehouse_id==Stock.warehouse_id)).where(Stock.qty!=0).order_by(Stock.id))
+    if warehouse_code: q=q.where(Warehouse.code==warehouse_code)
+    if only_fifo: q=q.where(Item.cost_method=="FIFO")
+    rows=[]; total=0.0
+    for icode,wcode,method,qty,avg,lq,lv in db.execute(q):
+        val=lv+max(qty-lq,0.0)*avg if method=="FIFO" else qty*avg
+        total+=val
+        rows.append({"item_code":icode,"warehouse_code":wcode,"cost_method":method,"qty":qty,"layered_qty":lq,"avg_cost":avg,
+                     "unit_cost":round(val/qty,4) if qty else 0.0,"value":round(val,2)})
+    return {"total":round(total,2),"rows":rows}
+
+@app.get("/stock/alerts")
+def stock_alerts(warehouse_code:Optional[str]=None, total:Optional[bool]=None, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Depo","Muhasebe"))):
+    """min_stock altındaki kalemler; low_stock kümesinden okunur (O(uyarı sayısı)).
+    total=true yalnız depo toplamları, false yalnız depo bazında; warehouse_code ile tek depo."""
+    # warehouse_id=0 (toplam) hiçbir depoyla eşleşmez -> warehouse_code None
+    q=(select(Item.code, Warehouse.code, LowStock.qty, LowStock.min_stock, LowStock.since)
+       .join(Item, Item.id==LowStock.item_id).outerjoin(Warehouse, Warehouse.id==LowStock.warehouse_id).order_by(LowStock.item_id, LowStock.warehouse_id))
+    if warehouse_code:
+        wh_id=master.get(db, "wh", warehouse_code)
+        if not wh_id: raise HTTPException(400,"warehouse not found")
+        q=q.where(LowStock.warehouse_id==wh_id)
+    elif total is not None: q=q.where(LowStock.warehouse_id==0 if total else LowStock.warehouse_id!=0)
+    return [{"item_code":ic,"warehouse_code":wc,"qty":q_,"min_stock":m,"shortage":round(m-q_,4),"since":since}
+            for ic,wc,q_,m,since in db.execute(q)]
+
+@app.get("/stock/alerts/feed")
+def stock_alerts_feed(since:int=0, limit:int=1000, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Depo","Muhasebe"))):
+    """since imlecinden sonraki eşik geçişleri; yanıttaki next ile devam edilir."""
+    rows=db.execute(select(LowStockEvent.id, LowStockEvent.ts, Item.code, Warehouse.code, LowStockEvent.kind, LowStockEvent.qty, LowStockEvent.min_stock)
+                    .join(Item, Item.id==LowStockEvent.item_id).outerjoin(Warehouse, Warehouse.id==LowStockEvent.warehouse_id).where(LowStockEvent.id>since).order_by(LowStockEvent.id).limit(min(limit,10000))).all()
+    return {"next":rows[-1][0] if rows else since,
+            "events":[{"id":i,"ts":ts,"item_code":ic,"warehouse_code":wc,"kind":k,"qty":q,"min_stock":m} for i,ts,ic,wc,k,q,m in rows]}
+
+@app.post("/stock/alerts/rebuild")
+def stock_alerts_rebuild(db:Session=Depends(get_db), user=Depends(require_roles("Admin"))):
+    rebuild_low_stock(db.connection()); db.commit()
+    return {"alerts":db.execute(select(func.count()).select_from(LowStock)).scalar()}
+
 # --- Sales Docs ---
-def convert(db:Session, src_id:int, dst_type:str)->Document:
-    src=db.get(Document, src_id)
-    if not src: raise HTTPException(404,"source not found")
-    dst=Document(doc_type=dst_type, number=next_number(db, dst_type), party_id=src.party_id, currency=src.currency, notes=f"Converted from {src.doc_type} {src.number}")
-    db.add(dst); db.commit(); db.refresh(dst)
-    src_lines=db.execute(select(DocumentLine).where(DocumentLine.document_id==src.id)).scalars().all()
-    lines=[]
-    for sl in src_lines:
-        db.add(DocumentLine(document_id=dst.id, item_id=sl.item_id, qty=sl.qty, unit_price=sl.unit_price, vat_rate=sl.vat_rate, line_total=sl.line_total))
-        lines.append({"qty":sl.qty,"unit_price":sl.unit_price,"vat_rate":sl.vat_rate})
-    st,vt,gt=totals(lines); dst.subtotal, dst.vat_total, dst.grand_total=st,vt,gt; db.commit(); return dst
+def convert_many(db:Session, src_ids:list, dst_type:str)->list:
+    """Kaynak belgeleri küme tabanlı dönüştürür (commit etmez): numaralar tek adımda,
+    satırlar INSERT ... SELECT ile, toplamlar tek aggregate UPDATE ile."""
+    src_ids=list(dict.fromkeys(src_ids))
+    srcs={}
+    for part in chunked(src_ids):
+        srcs.update({r.id:r for r in db.execute(select(Document.id, Document.doc_type, Document.number, Document.party_id, Document.currency).where(Document.id.in_(part)))})
+    done=set()
+    for part in chunked(src_ids):
+        done.update(db.execute(select(DocumentLink.src_id).where(DocumentLink.src_id.in_(part), DocumentLink.dst_type==dst_type)).scalars())
+    results={}; todo=[]
+    for sid in src_ids:
+        if sid not in srcs: results[sid]={"src_id":sid,"ok":False,"error":"source not found"}
+        elif sid in done: results[sid]={"src_id":sid,"ok":False,"error":"already converted"}
+        else: todo.append(sid)
+    if todo:
+        nums=next_numbers(db, dst_type, len(todo))
+        heads=[dict(doc_type=dst_type, number=n, date=datetime.utcnow(), party_id=srcs[sid].party_id, currency=srcs[sid].currency,
+                    notes=f"Converted from {srcs[sid].doc_type} {srcs[sid].number}", subtotal=0.0, vat_total=0.0, grand_total=0.0, status="OPEN")
+               for sid,n in zip(todo, nums)]
+        dst_ids=db.execute(insert(Document).returning(Document.id, sort_by_parameter_order=True), heads).scalars().all()
+        # eşzamanlı istek aynı kaynağı arada dönüştürdüyse tekillik (commit'te değil) bu INSERT'te patlar:
+        # çağıran retrying() ile geri alıp yeniden dener, ikinci turda "already converted" döner
+        db.execute(insert(DocumentLink), [dict(src_id=sid, dst_id=did, dst_type=dst_type) for sid,did in zip(todo, dst_ids)])
+        amt=DocumentLine.qty*DocumentLine.unit_price; vat=amt*func.coalesce(DocumentLine.vat_rate,20)/100
+        agg=lambda e: select(func.coalesce(func.sum(e),0.0)).where(DocumentLine.document_id==Document.id).scalar_subquery()
+        for part in chunked(dst_ids):
+            db.execute(insert(DocumentLine).from_select(["document_id","item_id","qty","unit_price","vat_rate","line_total"],
+                select(DocumentLink.dst_id, DocumentLine.item_id, DocumentLine.qty, DocumentLine.unit_price, DocumentLine.vat_rate, DocumentLine.line_total)
+                .join(DocumentLink, DocumentLink.src_id==DocumentLine.document_id).where(DocumentLink.dst_id.in_(part)).order_by(DocumentLine.id)))
+            db.execute(update(Document).where(Document.id.in_(part))
+                       .values(subtotal=func.round(agg(amt),2), vat_total=func.round(agg(vat),2), grand_total=func.round(agg(amt+vat),2)))
+        if dst_type=="INVOICE":
+            for part in chunked(dst_ids):
+                post_party_debits(db, db.execute(select(Document.party_id, Document.grand_total, Document.date).where(Document.id.in_(part))).all())
+        for sid,did,h in zip(todo, dst_ids, heads): results[sid]={"src_id":sid,"ok":True,"id":did,"number":h["number"]}
+    return [results[sid] for sid in src_ids]
+
+def convert(db:Session, src_id:int, dst_type:str)->dict:
+    def run():
+        (r,)=convert_many(db, [src_id], dst_type)
+        if not r["ok"]: db.rollback(); raise HTTPException(404 if r["error"]=="source not found" else 409, r["error"])
+        return r
+    return retrying(db, run)
 
 class DocumentOut(BaseModel):
     id:int; doc_type:str; number:str; grand_total:float
+def insert_docs(db:Session, docs:list)->tuple:
+    """DocumentIn listesini tek geçişte yazar (commit etmez): kodlar toplu çözülür,
+    eksik stok kartları açılır, numaralar tür başına tek seferde ayrılır,
+    başlık ve satırlar toplu INSERT edilir. Döner: (belge başına sonuç, yeni ItemRef'ler)."""
+    results=[None]*len(docs)
+    parties=master.many(db, "party", [d.party_code for d in docs])
+    items=master.many(db, "item", [ln.item_code for d in docs for ln in d.lines])
+    custom=[d.number for d in docs if d.number]
+    taken=set()
+    for part in chunked(custom): taken.update(db.execute(select(Document.number).where(Document.number.in_(part))).scalars())
+    ok=[]; seen=set()
+    for i,d in enumerate(docs):
+        if d.party_code not in parties: results[i]={"index":i,"ok":False,"error":"party not found"}
+        elif d.number and (d.number in taken or d.number in seen): results[i]={"index":i,"ok":False,"error":"number exists"}
+        else: ok.append(i); seen.add(d.number)
+    # numaralar yazmalardan önce: blok ayırma ayrı bağlantı kullanır (SQLite tek yazıcı)
+    by_type={}
+    for i in ok:
+        if not docs[i].number: by_type.setdefault(docs[i].doc_type, []).append(i)
+    numbers_for={}
+    for t,idx in by_type.items(): numbers_for.update(zip(idx, next_numbers(db, t, len(idx), exclude=seen)))
+    for t in {docs[i].doc_type for i in ok if docs[i].number}: advance_numbers(db, t, [docs[i].number for i in ok if docs[i].doc_type==t])
+    new_items={}
+    missing=sorted({ln.item_code for i in ok for ln in docs[i].lines if ln.item_code not in items})
+    if missing:
+        ids=db.execute(insert(Item).returning(Item.id, sort_by_parameter_order=True),
+                       [dict(code=c, name=c, type="Mamul", unit="adet", vat_rate=20.0, min_stock=0.0, cost_method="AVERAGE") for c in missing]).scalars().all()
+        for c,iid in zip(missing, ids): new_items[c]=items[c]=ItemRef(iid, 20.0, "adet", "Mamul", "AVERAGE")
+        master.touch(db)
+    heads=[]; tots={}
+    for i in ok:
+        d=docs[i]; tots[i]=totals([ln.model_dump() for ln in d.lines])
+        heads.append(dict(doc_type=d.doc_type, number=d.number or numbers_for[i], date=datetime.utcnow(), party_id=parties[d.party_code], currency=d.currency,
+                          notes=d.notes, subtotal=tots[i][0], vat_total=tots[i][1], grand_total=tots[i][2], status="OPEN"))
+    if heads:
+        doc_ids=db.execute(insert(Document).returning(Document.id, sort_by_parameter_order=True), heads).scalars().all()
+        lines=[dict(document_id=did, item_id=items[ln.item_code].id, qty=ln.qty, unit_price=ln.unit_price, vat_rate=ln.vat_rate,
+                    line_total=ln.qty*ln.unit_price*(1+ln.vat_rate/100)) for i,did in zip(ok, doc_ids) for ln in docs[i].lines]
+        if lines: db.execute(insert(DocumentLine), lines)
+        for i,did,h in zip(ok, doc_ids, heads):
+            results[i]={"index":i,"ok":True,"id":did,"doc_type":h["doc_type"],"number":h["number"],"grand_total":h["grand_total"]}
+        post_party_debits(db, [(h["party_id"], h["grand_total"], h["date"]) for h in heads if h["doc_type"]=="INVOICE"])
+    return results, new_items
+
 @app.post("/docs/", response_model=DocumentOut)
 def create_doc(p:DocumentIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis","Muhasebe"))):
-    party=db.execute(select(Party).where(Party.code==p.party_code)).scalar_one_or_none()
-    if not party: raise HTTPException(400,"party not found")
-    number=p.number or next_number(db, p.doc_type)
-    doc=Document(doc_type=p.doc_type, number=number, party_id=party.id, currency=p.currency, notes=p.notes)
-    db.add(doc); db.commit(); db.refresh(doc)
-    lines=[]
-    for ln in p.lines:
-        it=db.execute(select(Item).where(Item.code==ln.item_code)).scalar_one_or_none()
-        if not it: it=Item(code=ln.item_code, name=ln.item_code, type="Mamul", unit="adet"); db.add(it); db.commit(); db.refresh(it)
-        db.add(DocumentLine(document_id=doc.id, item_id=it.id, qty=ln.qty, unit_price=ln.unit_price, vat_rate=ln.vat_rate, line_total=ln.qty*ln.unit_price*(1+ln.vat_rate/100)))
-        lines.append({"qty":ln.qty,"unit_price":ln.unit_price,"vat_rate":ln.vat_rate})
-    st,vt,gt=totals(lines); doc.subtotal, doc.vat_total, doc.grand_total=st,vt,gt; db.commit()
-    return DocumentOut(id=doc.id, doc_type=doc.doc_type, number=doc.number, grand_total=doc.grand_total)
+    (r,),new_items=insert_docs(db, [p])
+    if not r["ok"]: db.rollback(); raise HTTPException(400, r["error"])
+    db.commit()
+    for c,ref in new_items.items(): master.put("item", c, ref)
+    return DocumentOut(**r)
+
+@app.post("/docs/bulk")
+def create_docs_bulk(rows:list=Depends(json_rows), chunk:int=Query(500, ge=1), user=Depends(require_roles("Admin","Satis","Muhasebe"))):
+    """NDJSON ya da JSON dizi DocumentIn; chunk adet belgede bir commit.
+    Yanıt belge başına bir NDJSON satırı olarak akar; commit'i başarısız parça hatalı döner."""
+    def gen():
+        db=SessionLocal()
+        try:
+            for start in range(0, len(rows), chunk):
+                docs=[]; bad=[]
+                for i,r in enumerate(rows[start:start+chunk], start):
+                    try: docs.append((i, DocumentIn.model_validate(r)))
+                    except Exception as e: bad.append({"index":i,"ok":False,"error":"invalid document: "+str(e).splitlines()[0]})
+                try:
+                    res,new_items=insert_docs(db, [d for _,d in docs]); db.commit()
+                    for c,ref in new_items.items(): master.put("item", c, ref)
+                except Exception as e:
+                    db.rollback(); res=[{"ok":False,"error":"chunk failed: "+str(e).splitlines()[0]} for _ in docs]
+                for (i,_),r in zip(docs, res): r["index"]=i
+                yield "".join(json.dumps(r)+"\n" for r in sorted(bad+res, key=lambda r:r["index"]))
+        finally: db.close()
+    return StreamingResponse(gen(), media_type="application/x-ndjson")
 
 @app.post("/docs/{doc_id}/to-order")
-def to_order(doc_id:int, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis"))): return {"id": convert(db, doc_id, "ORDER").id}
+def to_order(doc_id:int, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis"))): return {"id": convert(db, doc_id, "ORDER")["id"]}
 @app.post("/docs/{doc_id}/to-dispatch")
-def to_dispatch(doc_id:int, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis","Depo"))): return {"id": convert(db, doc_id, "DISPATCH").id}
+def to_dispatch(doc_id:int, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis","Depo"))): return {"id": convert(db, doc_id, "DISPATCH")["id"]}
 @app.post("/docs/{doc_id}/to-invoice")
-def to_invoice(doc_id:int, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis","Muhasebe"))): return {"id": convert(db, doc_id, "INVOICE").id}
+def to_invoice(doc_id:int, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis","Muhasebe"))): return {"id": convert(db, doc_id, "INVOICE")["id"]}
+
+CONVERT_ROLES={"ORDER":{"Admin","Satis"},"DISPATCH":{"Admin","Satis","Depo"},"INVOICE":{"Admin","Satis","Muhasebe"}}
+class ConvertIn(BaseModel): src_ids:List[int]; dst_type:str
+@app.post("/docs/convert")
+def convert_docs(p:ConvertIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Satis","Depo","Muhasebe"))):
+    if p.dst_type not in CONVERT_ROLES: raise HTTPException(400,"invalid dst_type")
+    if not (user.roles & CONVERT_ROLES[p.dst_type]): raise HTTPException(403,"Insufficient role")
+    res=retrying(db, lambda: convert_many(db, p.src_ids, p.dst_type))
+    return {"converted":sum(1 for r in res if r["ok"]),"results":res}
 
 # --- Finance ---
 @app.post("/finance/accounts")
 def create_account(p:CashBankCreate, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Muhasebe"))):
     if p.account_type=="CASH":
         if db.execute(select(CashAccount).where(CashAccount.name==p.name)).scalar_one_or_none(): raise HTTPException(400,"exists")
-        acc=CashAccount(name=p.name); db.add(acc); db.commit(); return {"id":acc.id}
+        acc=CashAccount(name=p.name); db.add(acc); master.touch(db); db.commit(); master.add("CASH", acc); return {"id":acc.id}
     elif p.account_type=="BANK":
         if db.execute(select(BankAccount).where(BankAccount.name==p.name)).scalar_one_or_none(): raise HTTPException(400,"exists")
-        acc=BankAccount(name=p.name, iban=p.iban); db.add(acc); db.commit(); return {"id":acc.id}
+        acc=BankAccount(name=p.name, iban=p.iban); db.add(acc); master.touch(db); db.commit(); master.add("BANK", acc); return {"id":acc.id}
     else: raise HTTPException(400,"invalid type")
 
+def ensure_balances(db, pids):
+    # önce cari satırlarına dokun: yazma kilidi (SQLite) / satır kilidi okumalardan önce alınır,
+    # eşzamanlı mahsuplar aynı unapplied/amount_left değerini okuyup birbirini ezmez
+    db.execute(update(PartyBalance).where(PartyBalance.party_id.in_(list(pids))).values(updated_at=datetime.utcnow()))
+    have=set(db.execute(select(PartyBalance.party_id).where(PartyBalance.party_id.in_(list(pids)))).scalars())
+    miss=[dict(party_id=p, debit=0.0, credit=0.0, unapplied=0.0, cheque_total=0.0, updated_at=datetime.utcnow()) for p in pids if p not in have]
+    if miss: db.execute(insert(PartyBalance), miss)
+
+def post_party_debits(db, rows):
+    """rows: [(party_id, tutar, belge tarihi)]; vade = tarih + Party.vade_gun. Önce bekleyen
+    (unapplied) alacak mahsup edilir, kalan açık kalem olur. Cari başına tek UPDATE."""
+    rows=[r for r in rows if r[0] and r[1]]
+    if not rows: return
+    pids={r[0] for r in rows}; ensure_balances(db, pids)
+    vade=dict(db.execute(select(Party.id, Party.vade_gun).where(Party.id.in_(list(pids)))).all())
+    unapplied=dict(db.execute(select(PartyBalance.party_id, PartyBalance.unapplied).where(PartyBalance.party_id.in_(list(pids)))).all())
+    debit={}; used={}; items=[]
+    for pid,amt,d in rows:
+        debit[pid]=debit.get(pid,0.0)+amt
+        use=min(unapplied[pid]-used.get(pid,0.0), amt); used[pid]=used.get(pid,0.0)+use
+        if amt-use>0: items.append(dict(party_id=pid, due_date=d+timedelta(days=vade.get(pid) or 0), amount=amt, amount_left=amt-use))
+    if items: db.execute(insert(PartyOpenItem), items)
+    t=PartyBalance.__table__
+    db.execute(t.update().where(t.c.party_id==bindparam("pid")).values(debit=t.c.debit+bindparam("d"), unapplied=t.c.unapplied-bindparam("u"), updated_at=datetime.utcnow()),
+               [dict(pid=p, d=debit[p], u=used.get(p,0.0)) for p in pids])
+
+def post_party_credit(db, pid:int, amount:float, cheque:bool=False):
+    """Alacağı en eski vadeli açık kalemlerden düşer; yalnızca kapanan kalemlere dokunur."""
+    if not (pid and amount): return
+    ensure_balances(db, [pid]); left=amount
+    for iid,al in db.execute(select(PartyOpenItem.id, PartyOpenItem.amount_left).where(PartyOpenItem.party_id==pid)
+                             .order_by(PartyOpenItem.due_date, PartyOpenItem.id)).all():
+        if left<=1e-9: break
+        use=min(al, left); left-=use
+        if al-use<=1e-9: db.execute(PartyOpenItem.__table__.delete().where(PartyOpenItem.id==iid))
+        else: db.execute(update(PartyOpenItem).where(PartyOpenItem.id==iid).values(amount_left=PartyOpenItem.amount_left-use))
+    db.execute(update(PartyBalance).where(PartyBalance.party_id==pid).values(credit=PartyBalance.credit+amount, unapplied=PartyBalance.unapplied+max(left,0.0),
+               cheque_total=PartyBalance.cheque_total+(amount if cheque else 0.0), updated_at=datetime.utcnow()))
+
 @app.post("/finance/tx")
 def create_tx(p:TxCreate, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Muhasebe"))):
+    party_id=None
+    if p.party_code:
+        party_id=master.get(db, "party", p.party_code)
+        if not party_id: raise HTTPException(400,"party not found")
+        if p.direction not in ("IN","OUT"): raise HTTPException(400,"invalid direction")
     if p.account_type=="CASH":
-        acc=db.execute(select(CashAccount).where(CashAccount.name==p.account_name)).scalar_one_or_none()
-        if not acc: raise HTTPException(400,"cash not found")
-        tx=CashBankTx(account_type="CASH", account_id=acc.id, direction=p.direction, amount=p.amount, currency=p.currency, ref=p.ref, notes=p.notes)
+        acc_id=master.get(db, "CASH", p.account_name)
+        if not acc_id: raise HTTPException(400,"cash not found")
+        tx=CashBankTx(account_type="CASH", account_id=acc_id, direction=p.direction, party_id=party_id, amount=p.amount, currency=p.currency, ref=p.ref, notes=p.notes)
     elif p.account_type=="BANK":
-        acc=db.execute(select(BankAccount).where(BankAccount.name==p.account_name)).scalar_one_or_none()
-        if not acc: raise HTTPException(400,"bank not found")
-        tx=CashBankTx(account_type="BANK", account_id=acc.id, direction=p.direction, amount=p.amount, currency=p.currency, ref=p.ref, notes=p.notes)
+        acc_id=master.get(db, "BANK", p.account_name)
+        if not acc_id: raise HTTPException(400,"bank not found")
+        tx=CashBankTx(account_type="BANK", account_id=acc_id, direction=p.direction, party_id=party_id, amount=p.amount, currency=p.currency, ref=p.ref, notes=p.notes)
     else: raise HTTPException(400,"invalid type")
-    db.add(tx); db.commit(); return {"id":tx.id}
+    db.add(tx)
+    # tahsilat (IN) alacak, ödeme (OUT) borç
+    if party_id and p.direction=="IN": post_party_credit(db, party_id, p.amount)
+    elif party_id: post_party_debits(db, [(party_id, p.amount, datetime.utcnow())])
+    db.commit(); return {"id":tx.id}
 
 @app.post("/finance/cheques")
 def create_cheque(p:ChequeCreate, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Muhasebe"))):
     if db.execute(select(Cheque).where(Cheque.number==p.number)).scalar_one_or_none(): raise HTTPException(400,"exists")
-    ch=Cheque(number=p.number, amount=p.amount, currency=p.currency, due_date=p.due_date, status=p.status, notes=p.notes)
-    db.add(ch); db.commit(); return {"id":ch.id}
+    party_id=master.get(db, "party", p.party_code)
+    if p.party_code and not party_id: raise HTTPException(400,"party not found")
+    ch=Cheque(number=p.number, party_id=party_id, amount=p.amount, currency=p.currency, due_date=p.due_date, status=p.status, notes=p.notes)
+    db.add(ch)
+    if party_id: post_party_credit(db, party_id, p.amount, cheque=True)
+    db.commit(); return {"id":ch.id}
+
+@app.get("/finance/parties/{code}/balance")
+def party_balance(code:str, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Muhasebe","Satis"))):
+    pid=master.get(db, "party", code)
+    if not pid: raise HTTPException(404,"party not found")
+    b=db.get(PartyBalance, pid); now=datetime.utcnow()
+    open_total, overdue=db.execute(select(func.coalesce(func.sum(PartyOpenItem.amount_left),0.0),
+        func.coalesce(func.sum(case((PartyOpenItem.due_date<now, PartyOpenItem.amount_left), else_=0.0)),0.0)).where(PartyOpenItem.party_id==pid)).one()
+    if not b: return {"party_code":code,"debit":0.0,"credit":0.0,"balance":0.0,"unapplied_credit":0.0,"cheque_total":0.0,"open":0.0,"overdue":0.0}
+    return {"party_code":code,"debit":round(b.debit,2),"credit":round(b.credit,2),"balance":round(b.debit-b.credit,2),"unapplied_credit":round(b.unapplied,2),
+            "cheque_total":round(b.cheque_total,2),"open":round(open_total,2),"overdue":round(overdue,2),"updated_at":b.updated_at}
+
+AGING_BUCKETS=[(0,"current"),(30,"1-30"),(60,"31-60"),(90,"61-90"),(180,"91-180")]
+@app.get("/finance/aging")
+def aging(as_of:Optional[datetime]=None, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Muhasebe"))):
+    """Açık kalemlerin vadeye göre yaşlandırması (gecikme günü: current, 1-30, 31-60, 61-90, 91-180, 180+).
+    Yalnızca açık kalemler okunur; işlem geçmişi büyüdükçe süre değişmez."""
+    as_of=as_of or datetime.utcnow()
+    bucket=case(*[(PartyOpenItem.due_date>=as_of-timedelta(days=d), name) for d,name in AGING_BUCKETS], else_="180+")
+    out={}
+    for code,name,b,amt in db.execute(select(Party.code, Party.name, bucket, func.sum(PartyOpenItem.amount_left))
+                                      .join(Party, Party.id==PartyOpenItem.party_id).group_by(Party.code, Party.name, bucket)):
+        r=out.setdefault(code, dict({"party_code":code,"name":name,"total":0.0}, **{n:0.0 for _,n in AGING_BUCKETS+[(0,"180+")]}))
+        r[b]=round(amt,2); r["total"]=round(r["total"]+amt,2)
+    return {"as_of":as_of,"rows":sorted(out.values(), key=lambda r:-r["total"])}
+
+@app.get("/finance/cheques/maturity")
+def cheque_maturity(from_:datetime=Query(alias="from"), to:datetime=Query(...), status:Optional[str]=None,
+                    db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Muhasebe"))):
+    # cheques.due_date indeksinde aralık taraması
+    q=(select(Cheque.number, Party.code, Cheque.amount, Cheque.currency, Cheque.due_date, Cheque.status)
+       .outerjoin(Party, Party.id==Cheque.party_id).where(Cheque.due_date>=from_, Cheque.due_date<=to).order_by(Cheque.due_date))
+    if status: q=q.where(Cheque.status==status)
+    rows=[{"number":n,"party_code":pc,"amount":a,"currency":c,"due_date":d,"status":st} for n,pc,a,c,d,st in db.execute(q)]
+    return {"count":len(rows),"total":round(sum(r["amount"] for r in rows),2),"rows":rows}
 
 # --- Production ---
 def next_wo(db:Session)->str:
-    year=datetime.utcnow().strftime("%y")
-    last=db.execute(select(WorkOrder).order_by(desc(WorkOrder.id)).limit(1)).scalar_one_or_none()
-    n=(last.id if last else 0)+1
-    return f"WO{year}-{n:06d}"
+    pre=f"WO{datetime.utcnow().strftime('%y')}-"
+    return f"{pre}{numbers.take(db, 'WO', 1, max_suffix(WorkOrder.number, pre))[0]:06d}"
+
+def material_costs(db:Session, wo_ids)->dict:
+    """wo_id -> malzeme maliyeti; tek GROUP BY sorgusu. Tüketim anındaki maliyet yoksa
+    (eski kayıt) tüketilen depodaki güncel avg_cost kullanılır."""
+    out={}
+    cost=func.coalesce(WorkOrderConsumption.unit_cost, Stock.avg_cost, 0.0)
+    for part in chunked(wo_ids):
+        q=(select(WorkOrderConsumption.wo_id, func.sum(WorkOrderConsumption.qty*cost))
+           .outerjoin(Stock, (Stock.item_id==WorkOrderConsumption.item_id) & (Stock.warehouse_id==WorkOrderConsumption.wh_id))
+           .where(WorkOrderConsumption.wo_id.in_(part)).group_by(WorkOrderConsumption.wo_id))
+        out.update({w:c or 0.0 for w,c in db.execute(q)})
+    return out
+
+def open_wos(db:Session, wo_ids:Optional[List[int]]=None):
+    q=select(WorkOrder.id, WorkOrder.number, WorkOrder.product_id, WorkOrder.target_qty, WorkOrder.produced_qty)
+    q=q.where(WorkOrder.id.in_(wo_ids)) if wo_ids else q.where(WorkOrder.status.in_(("IN_PROGRESS","OPEN")))
+    return db.execute(q).all()
+
+@app.get("/production/costing")
+def wo_costing(wo_id:List[int]=Query(None), db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Uretim","Muhasebe"))):
+    """Verilen (yoksa tüm açık) iş emirlerinin malzeme maliyeti, tek gruplu sorguyla."""
+    wos=open_wos(db, wo_id); costs=material_costs(db, [w.id for w in wos])
+    return [{"wo_id":w.id,"number":w.number,"material_cost":round(costs.get(w.id,0.0),4),"produced_qty":w.produced_qty,
+             "unit_material_cost":round(costs.get(w.id,0.0)/w.produced_qty,4) if w.produced_qty else None} for w in wos]
+
+class BomLineIn(BaseModel): component_code:str; qty:float
+class BomIn(BaseModel): lines:List[BomLineIn]
+
+def load_boms(db:Session)->dict:
+    # tüm reçete tek sorguda: parent_id -> [(component_id, qty)]
+    boms={}
+    for parent,comp,qty in db.execute(select(BomLine.parent_id, BomLine.component_id, BomLine.qty)): boms.setdefault(parent,[]).append((comp,qty))
+    return boms
+
+def exploder(boms:dict):
+    """explode(item_id) -> {yaprak item_id: 1 birim için miktar}; alt montaj sonuçları memoize edilir."""
+    memo={}; visiting=set()
+    def explode(item_id):
+        if item_id in memo: return memo[item_id]
+        if item_id not in boms: return {item_id:1.0}
+        if item_id in visiting: raise HTTPException(400,"BOM cycle")
+        visiting.add(item_id); out={}
+        for comp,qty in boms[item_id]:
+            for leaf,q in explode(comp).items(): out[leaf]=out.get(leaf,0.0)+qty*q
+        visiting.discard(item_id); memo[item_id]=out
+        return out
+    return explode
+
+@app.put("/production/bom/{item_code}")
+def set_bom(item_code:str, p:BomIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Uretim"))):
+    parent=master.get(db, "item", item_code)
+    if not parent: raise HTTPException(400,"item not found")
+    if parent.type!="Mamul": raise HTTPException(400,"BOM only for Mamul items")
+    bad=[l.component_code for l in p.lines if not l.qty>0]
+    if bad: raise HTTPException(400, f"qty must be > 0: {', '.join(bad)}")
+    seen=set(); dup=sorted({l.component_code for l in p.lines if l.component_code in seen or seen.add(l.component_code)})
+    if dup: raise HTTPException(400, f"duplicate component: {', '.join(dup)}")
+    comps=master.many(db, "item", [l.component_code for l in p.lines])
+    missing=[l.component_code for l in p.lines if l.component_code not in comps]
+    if missing: raise HTTPException(400, f"component not found: {', '.join(missing)}")
+    boms=load_boms(db); boms[parent.id]=[(comps[l.component_code].id, l.qty) for l in p.lines]
+    explode=exploder(boms); explode(parent.id)  # döngü kontrolü
+    db.execute(BomLine.__table__.delete().where(BomLine.parent_id==parent.id))
+    if p.lines: db.execute(insert(BomLine), [dict(parent_id=parent.id, component_id=c, qty=q) for c,q in boms[parent.id]])
+    db.commit(); return {"ok":True,"lines":len(p.lines)}
+
+@app.get("/production/bom/{item_code}")
+def get_bom(item_code:str, explode:bool=False, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Uretim","Depo"))):
+    parent=master.get(db, "item", item_code)
+    if not parent: raise HTTPException(400,"item not found")
+    if explode:
+        leaves=exploder(load_boms(db))(parent.id); codes=code_map(db, Item, leaves)
+        return [{"component_code":codes.get(i),"qty":q} for i,q in leaves.items()]
+    rows=db.execute(select(Item.code, BomLine.qty).join(Item, Item.id==BomLine.component_id).where(BomLine.parent_id==parent.id).order_by(BomLine.id)).all()
+    return [{"component_code":c,"qty":q} for c,q in rows]
+
+class MrpIn(BaseModel): wo_ids:Optional[List[int]]=None
+@app.post("/production/mrp")
+def mrp(p:MrpIn, db:Session=Depends(get_read_db), user=Depends(require_roles("Admin","Uretim","Depo"))):
+    """Açık iş emirlerinin kalan miktarını çok seviyeli reçeteyle yaprak malzemelere açar,
+    eldeki stokla (tüm depolar) netler. Reçete ve stok birer sorguyla okunur."""
+    explode=exploder(load_boms(db)); gross={}
+    for w in open_wos(db, p.wo_ids):
+        remaining=max((w.target_qty or 0)-(w.produced_qty or 0), 0.0)
+        if not remaining: continue
+        for leaf,q in explode(w.product_id).items():
+            if leaf!=w.product_id: gross[leaf]=gross.get(leaf,0.0)+remaining*q
+    on_hand={}; codes={}
+    for part in chunked(gross):
+        for i,c,q in db.execute(select(Item.id, Item.code, func.sum(Stock.qty)).outerjoin(Stock, Stock.item_id==Item.id)
+                                .where(Item.id.in_(part)).group_by(Item.id, Item.code)): codes[i]=c; on_hand[i]=q
+    return [{"item_code":codes.get(i),"gross":round(g,4),"on_hand":round(on_hand.get(i) or 0.0,4),"net":round(max(g-(on_hand.get(i) or 0.0),0.0),4)}
+            for i,g in sorted(gross.items())]
 
 @app.post("/production/wo")
 def create_wo(p:WOCreate, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Uretim"))):
-    prod=db.execute(select(Item).where(Item.code==p.product_code)).scalar_one_or_none()
+    prod=master.get(db, "item", p.product_code)
     if not prod: raise HTTPException(400,"product not found")
     wo=WorkOrder(number=next_wo(db), product_id=prod.id, target_qty=p.target_qty, notes=p.notes, status="IN_PROGRESS")
     db.add(wo); db.commit(); return {"id":wo.id,"number":wo.number}
@@ -352,34 +1538,91 @@ def create_wo(p:WOCreate, db:Session=Depends(get_db), user=Depends(require_roles
 def consume(p:WOConsumeIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Uretim","Depo"))):
     wo=db.get(WorkOrder, p.wo_id)
     if not wo or wo.status not in ("IN_PROGRESS","OPEN"): raise HTTPException(400,"wo closed/not found")
-    it=db.execute(select(Item).where(Item.code==p.item_code)).scalar_one_or_none()
+    it=master.get(db, "item", p.item_code)
     if not it: raise HTTPException(400,"item not found")
-    wh=db.execute(select(Warehouse).where(Warehouse.code==p.warehouse_code)).scalar_one_or_none()
-    if not wh: raise HTTPException(400,"warehouse not found")
-    st=db.query(Stock).filter_by(item_id=it.id, warehouse_id=wh.id).one_or_none()
-    if not st or st.qty < p.qty: raise HTTPException(400,"insufficient")
-    st.qty -= p.qty; db.add(WorkOrderConsumption(wo_id=wo.id, item_id=it.id, qty=p.qty, wh_id=wh.id, ref=p.ref)); db.commit(); return {"ok":True}
+    wh_id=master.get(db, "wh", p.warehouse_code)
+    if not wh_id: raise HTTPException(400,"warehouse not found")
+    wo_id, wo_number=wo.id, wo.number
+    def run():
+        if it.cost_method!="FIFO":
+            r=take_stock(db, it.id, wh_id, p.qty)
+            if r is None: raise HTTPException(400,"insufficient")
+            track_low_stock(db.connection(), {(it.id, wh_id):r[:2]}); unit_cost=r[2]
+        else:
+            lock_stock(db, [it.id], [wh_id]); cache={}; st=get_stock(db, cache, it.id, wh_id)
+            if not st or st.qty < p.qty: raise HTTPException(400,"insufficient")
+            unit_cost=pieces_cost(fifo_issue(db, cache, it.id, wh_id, p.qty, st.avg_cost))/p.qty if p.qty else st.avg_cost
+            st.qty -= p.qty
+        db.add(WorkOrderConsumption(wo_id=wo_id, item_id=it.id, qty=p.qty, wh_id=wh_id, ref=p.ref, unit_cost=unit_cost))
+        db.add(StockMove(item_id=it.id, wh_from=wh_id, qty=p.qty, unit_price=unit_cost, move_type="OUT", ref=p.ref or wo_number)); return {"ok":True}
+    return retrying(db, run)
 
 @app.post("/production/produce")
 def produce(p:WOProduceIn, db:Session=Depends(get_db), user=Depends(require_roles("Admin","Uretim"))):
     wo=db.get(WorkOrder, p.wo_id)
     if not wo or wo.status not in ("IN_PROGRESS","OPEN"): raise HTTPException(400,"wo closed/not found")
-    wh=db.execute(select(Warehouse).where(Warehouse.code==p.warehouse_code)).scalar_one_or_none()
-    if not wh: raise HTTPException(400,"warehouse not found")
-    cons=db.execute(select(WorkOrderConsumption).where(WorkOrderConsumption.wo_id==wo.id)).scalars().all()
-    mat_cost=0.0
-    for c in cons:
-        any_stock=db.query(Stock).filter_by(item_id=c.item_id).first()
-        avg=any_stock.avg_cost if any_stock else 0.0
-        mat_cost += avg * c.qty
-    unit_cost=((mat_cost*(1+p.overhead_rate))/p.qty) if p.qty else 0.0
-    st_fg=db.query(Stock).filter_by(item_id=wo.product_id, warehouse_id=wh.id).one_or_none()
-    if not st_fg: st_fg=Stock(item_id=wo.product_id, warehouse_id=wh.id, qty=0.0, avg_cost=0.0); db.add(st_fg)
-    total_prev=st_fg.avg_cost*st_fg.qty
-    st_fg.qty += p.qty
-    st_fg.avg_cost=(total_prev + unit_cost*p.qty)/st_fg.qty if st_fg.qty else unit_cost
-    db.add(WorkOrderFG(wo_id=wo.id, product_id=wo.product_id, qty=p.qty, wh_id=wh.id, unit_cost=unit_cost))
-    wo.produced_qty += p.qty; db.commit(); return {"ok":True,"unit_cost":round(unit_cost,3)}
+    wh_id=master.get(db, "wh", p.warehouse_code)
+    if not wh_id: raise HTTPException(400,"warehouse not found")
+    wo_id, wo_number, product_id=wo.id, wo.number, wo.product_id
+    fg_fifo=db.execute(select(Item.cost_method).where(Item.id==product_id)).scalar()=="FIFO"
+    def run():
+        lock_stock(db, [product_id], [wh_id])
+        mat_cost=material_costs(db, [wo_id]).get(wo_id, 0.0)
+        unit_cost=((mat_cost*(1+p.overhead_rate))/p.qty) if p.qty else 0.0
+        st_fg=db.query(Stock).filter_by(item_id=product_id, warehouse_id=wh_id).one_or_none()
+        if not st_fg: st_fg=Stock(item_id=product_id, warehouse_id=wh_id, qty=0.0, avg_cost=0.0); db.add(st_fg)
+        total_prev=st_fg.avg_cost*st_fg.qty
+        st_fg.qty += p.qty
+        st_fg.avg_cost=(total_prev + unit_cost*p.qty)/st_fg.qty if st_fg.qty else unit_cost
+        if fg_fifo: cache={}; fifo_receive(db, cache, product_id, wh_id, p.qty, unit_cost); write_layers(db, cache)
+        db.add(WorkOrderFG(wo_id=wo_id, product_id=product_id, qty=p.qty, wh_id=wh_id, unit_cost=unit_cost))
+        db.add(StockMove(item_id=product_id, wh_to=wh_id, qty=p.qty, unit_price=unit_cost, move_type="IN", ref=wo_number))
+        db.execute(update(WorkOrder).where(WorkOrder.id==wo_id).values(produced_qty=WorkOrder.produced_qty+p.qty))
+        return {"ok":True,"unit_cost":round(unit_cost,3)}
+    return retrying(db, run)
+# --- Export ---
+def export_stmt(dataset:str, date_from, date_to, type_):
+    """Denetim dökümleri: kodlar SQL'de bağlanır, id sırası (devam imleci) ile.
+    Döner: (sorgu, kolonlar, id kolonu)."""
+    if dataset=="stock_moves":
+        wf,wt=aliased(Warehouse),aliased(Warehouse)
+        q=(select(StockMove.id, StockMove.ts, Item.code, wf.code, wt.code, StockMove.qty, StockMove.unit_price, StockMove.move_type, StockMove.ref)
+           .join(Item, Item.id==StockMove.item_id).outerjoin(wf, wf.id==StockMove.wh_from).outerjoin(wt, wt.id==StockMove.wh_to))
+        cols=["id","ts","item_code","wh_from_code","wh_to_code","qty","unit_price","move_type","ref"]; idc,dc,tc=StockMove.id,StockMove.ts,StockMove.move_type
+    elif dataset=="documents":
+        q=(select(Document.id, Document.doc_type, Document.number, Document.date, Party.code, Document.currency, Document.subtotal, Document.vat_total,
+                  Document.grand_total, Document.status, Document.notes).join(Party, Party.id==Document.party_id))
+        cols=["id","doc_type","number","date","party_code","currency","subtotal","vat_total","grand_total","status","notes"]; idc,dc,tc=Document.id,Document.date,Document.doc_type
+    elif dataset=="document_lines":
+        q=(select(DocumentLine.id, Document.id, Document.doc_type, Document.number, Document.date, Party.code, Item.code, DocumentLine.qty,
+                  DocumentLine.unit_price, DocumentLine.vat_rate, DocumentLine.line_total)
+           .join(Document, Document.id==DocumentLine.document_id).join(Party, Party.id==Document.party_id).join(Item, Item.id==DocumentLine.item_id))
+        cols=["id","document_id","doc_type","number","date","party_code","item_code","qty","unit_price","vat_rate","line_total"]; idc,dc,tc=DocumentLine.id,Document.date,Document.doc_type
+    elif dataset=="cash_bank_tx":
+        acc=case((CashBankTx.account_type=="CASH", CashAccount.name), else_=BankAccount.name)
+        q=(select(CashBankTx.id, CashBankTx.date, CashBankTx.account_type, acc, CashBankTx.direction, Party.code, CashBankTx.amount, CashBankTx.currency,
+                  CashBankTx.ref, CashBankTx.notes)
+           .outerjoin(CashAccount, (CashBankTx.account_type=="CASH") & (CashAccount.id==CashBankTx.account_id))
+           .outerjoin(BankAccount, (CashBankTx.account_type=="BANK") & (BankAccount.id==CashBankTx.account_id))
+           .outerjoin(Party, Party.id==CashBankTx.party_id))
+        cols=["id","date","account_type","account_name","direction","party_code","amount","currency","ref","notes"]; idc,dc,tc=CashBankTx.id,CashBankTx.date,CashBankTx.account_type
+    else: raise HTTPException(404,"unknown dataset")
+    if date_from: q=q.where(dc>=date_from)
+    if date_to: q=q.where(dc<date_to)
+    if type_: q=q.where(tc==type_)
+    return q, cols, idc
+
+@app.get("/export/{dataset}")
+def export(dataset:str, format:str="csv", gzip:bool=False, date_from:Optional[datetime]=None, date_to:Optional[datetime]=None,
+           type:Optional[str]=None, after_id:int=0, limit:Optional[int]=None, user=Depends(require_roles("Admin","Muhasebe"))):
+    """dataset: stock_moves | documents | document_lines | cash_bank_tx. format=csv|ndjson, gzip=true ile sıkıştırılmış.
+    type: hareket/belge/hesap türü. Satırlar id sırasında akar; kopan indirme son alınan id ile after_id= vererek sürdürülür."""
+    if format not in ("csv","ndjson"): raise HTTPException(400,"invalid format")
+    q,cols,idc=export_stmt(dataset, date_from, date_to, type)
+    q=q.where(idc>after_id).order_by(idc)
+    if limit: q=q.limit(limit)
+    return stream_rows(q, format, cols, batch=2000, gzip=gzip, filename=f"{dataset}.{format}")
+
 # ---- Basit web arayüz (gömülü) ----
 MINI_UI = """<!doctype html><meta charset="utf-8"><title>Fixar Mini UI</title>
 <meta name="viewport" content="width=device-width,initial-scale=1">
@@ -433,3 +1676,8 @@ def root_page():
 @app.get("/ui", response_class=HTMLResponse)
 def mini_ui():
     return HTMLResponse(MINI_UI)
+
+if __name__=="__main__":
+    # python app.py migrate  -> şemayı güncelle (DB_AUTO_MIGRATE=0 ile çalışan kurulumlar için)
+    import sys
+    if sys.argv[1:]==["migrate"]: print("applied:", migrate() or "nothing")
@@ -0,0 +1,279 @@
+"""Fixar ERP yük/benchmark takımı.
+
+Ayrı bir SQLite dosyasına gerçekçi veri basar (ORM ile, HTTP'siz), ardından sıcak uçları
+uygulama içinde (TestClient, tek istemci) ve/veya yerel uvicorn'a eşzamanlı istemcilerle sürer.
+Uç başına throughput ve p50/p95/p99 (ms), Server-Timing'den SQL süresi/sorgu sayısı raporlanır;
+sonuç JSON'a yazılır, --baseline verilirse p95 ve throughput karşılaştırılır.
+
+Gereksinim: pip install -r requirements-dev.txt (httpx)
+
+  python bench.py --items 2000 --moves 20000 --docs 5000 --mode both --out bench.json
+  python bench.py --reuse --mode uvicorn --concurrency 16 --baseline bench.json --fail-on-regression
+"""
+import argparse, itertools, json, os, platform, random, socket, subprocess, sys, threading, time
+from datetime import datetime, timedelta
+
+HERE=os.path.dirname(os.path.abspath(__file__))
+ENDPOINTS=["login","stock_move","snapshot","doc_create","doc_convert","consume","produce"]
+ROLES=["Admin","Depo","Satis","Muhasebe","Uretim"]
+PASSWORD="bench"
+
+def parse_args(argv=None):
+    ap=argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    ap.add_argument("--db", default=os.path.join(HERE,"bench.db"), help="benchmark veritabanı (silinip yeniden basılır)")
+    ap.add_argument("--reuse", action="store_true", help="varsa mevcut --db'yi kullan, seed atlama")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--items", type=int, default=1000); ap.add_argument("--warehouses", type=int, default=5)
+    ap.add_argument("--parties", type=int, default=300); ap.add_argument("--moves", type=int, default=10000)
+    ap.add_argument("--docs", type=int, default=3000); ap.add_argument("--wos", type=int, default=20)
+    ap.add_argument("--mode", choices=["inprocess","uvicorn","both"], default="inprocess")
+    ap.add_argument("--requests", type=int, default=200, help="uç başına istek (login hariç)")
+    ap.add_argument("--login-requests", type=int, default=20, help="login bcrypt nedeniyle ayrı sayılır")
+    ap.add_argument("--concurrency", type=int, default=8, help="uvicorn modunda eşzamanlı istemci")
+    ap.add_argument("--workers", type=int, default=1, help="uvicorn worker sayısı")
+    ap.add_argument("--port", type=int, default=0, help="0: boş port seç")
+    ap.add_argument("--only", default="", help="virgüllü uç listesi: "+",".join(ENDPOINTS))
+    ap.add_argument("--out", default=os.path.join(HERE,"bench_results.json"))
+    ap.add_argument("--baseline", help="karşılaştırılacak önceki sonuç JSON'u")
+    ap.add_argument("--threshold", type=float, default=0.15, help="p95 artışı / throughput düşüşü bu oranı aşarsa gerileme")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    return ap.parse_args(argv)
+
+# ---- Seed ----
+def seed(A, a):
+    """Ana veriler toplu INSERT; hareketler apply_move ile (stok, FIFO katmanı, low-stock tutarlı),
+    belgeler insert_docs ile, iş emirleri next_wo ile. Tarihler son bir yıla yayılır."""
+    from sqlalchemy import insert
+    rnd=random.Random(a.seed); t0=time.perf_counter()
+    A.migrate()
+    db=A.SessionLocal()
+    try:
+        roles=db.execute(insert(A.Role).returning(A.Role.id, sort_by_parameter_order=True), [dict(name=r) for r in ROLES]).scalars().all()
+        uid=db.execute(insert(A.User).returning(A.User.id), dict(username="bench", hashed_password=A.hash_pw(PASSWORD), is_active=True)).scalar()
+        db.execute(insert(A.user_roles), [dict(user_id=uid, role_id=r) for r in roles])
+        db.execute(insert(A.Warehouse), [dict(code=f"D{i:02d}", name=f"Depo {i}") for i in range(1, a.warehouses+1)])
+        db.execute(insert(A.Item), [dict(code=f"HM{i:05d}" if i%10<7 else f"MM{i:05d}", name=f"Kalem {i}", type="Hammadde" if i%10<7 else "Mamul",
+                                         unit=rnd.choice(["adet","kg","lt"]), vat_rate=rnd.choice([1.0,10.0,20.0]), min_stock=rnd.choice([0.0,0.0,5.0,50.0]),
+                                         cost_method="FIFO" if i%10==3 else "AVERAGE") for i in range(1, a.items+1)])
+        db.execute(insert(A.Party), [dict(code=f"C{i:04d}", name=f"Cari {i}", type="Musteri" if i%4 else "Tedarikci",
+                                          vade_gun=rnd.choice([0,30,60,90,180]), risk_limit=rnd.choice([0.0,1e5,1e6])) for i in range(1, a.parties+1)])
+        A.master.touch(db); db.commit(); A.master.refresh(db, force=True)
+        items=list(A.master.maps["item"].items()); whs=list(A.master.maps["wh"].items())
+        raw=[(c,it) for c,it in items if it.type=="Hammadde"]
+        # bench OUT/consume tükenmesin: her hammadde ilk iki depoda bol stokla açılır
+        ops=[("IN",it,w,None,5000.0) for c,it in raw for _,w in whs[:2]]
+        for _ in range(max(0, a.moves-len(ops))):
+            it=rnd.choice(items)[1]; k=rnd.random(); w1,w2=rnd.sample(whs, 2) if len(whs)>1 else (whs[0],whs[0])
+            ops.append(("IN",it,w1[1],None,rnd.randint(1,200)) if k<0.6 else ("TRANSFER",it,w2[1],w1[1],rnd.randint(1,20)) if k<0.85 else ("OUT",it,None,w1[1],rnd.randint(1,20)))
+        start=datetime.utcnow()-timedelta(days=365); step=timedelta(days=365)/max(len(ops),1)
+        cache={}; rows=[]
+        for n,(mt,it,wh_to,wh_from,qty) in enumerate(ops):
+            p=A.StockMoveIn(item_code="", qty=qty, unit_price=round(rnd.uniform(1,500),2), move_type=mt, ref=f"SEED-{n}")
+            try: ms=A.apply_move(db, cache, it, wh_from, wh_to, p)
+            except A.HTTPException: continue  # yetersiz stok: geç
+            for m in ms: m["ts"]=start+step*n
+            rows+=ms
+            if len(rows)>=2000: db.execute(insert(A.StockMove), rows); rows=[]
+        if rows: db.execute(insert(A.StockMove), rows)
+        db.flush(); A.rebuild_low_stock(db.connection()); db.commit()
+        types=["QUOTE"]*5+["ORDER"]*3+["INVOICE"]*2; pcodes=list(A.master.maps["party"])
+        docs=[A.DocumentIn(doc_type=rnd.choice(types), party_code=rnd.choice(pcodes),
+                           lines=[A.DocLineIn(item_code=rnd.choice(items)[0], qty=rnd.randint(1,50), unit_price=round(rnd.uniform(1,900),2)) for _ in range(rnd.randint(1,8))])
+              for _ in range(a.docs)]
+        for part in A.chunked(docs):
+            A.insert_docs(db, part); db.commit()
+        for _ in range(a.wos):
+            prod=rnd.choice([it for c,it in items if it.type=="Mamul"] or [items[0][1]])
+            db.add(A.WorkOrder(number=A.next_wo(db), product_id=prod.id, target_qty=rnd.randint(100,10000), status="IN_PROGRESS")); db.commit()
+    finally: db.close()
+    return round(time.perf_counter()-t0, 2)
+
+# ---- Senaryolar ----
+class Fixture:
+    """İstek gövdelerini üretir; dönüştürme için dönüştürülmemiş QUOTE id'leri havuzdan tek tek verilir."""
+    def __init__(self, A, a):
+        from sqlalchemy import select
+        db=A.ReadSessionLocal()
+        try:
+            A.master.refresh(db, force=True)
+            self.items=list(A.master.maps["item"]); self.whs=list(A.master.maps["wh"]); self.parties=list(A.master.maps["party"])
+            self.raw=[c for c,it in A.master.maps["item"].items() if it.type=="Hammadde"]
+            linked=select(A.DocumentLink.src_id).where(A.DocumentLink.dst_type=="ORDER")
+            self.quotes=db.execute(select(A.Document.id).where(A.Document.doc_type=="QUOTE", A.Document.id.not_in(linked)).order_by(A.Document.id)).scalars().all()
+            self.wos=db.execute(select(A.WorkOrder.id).where(A.WorkOrder.status=="IN_PROGRESS")).scalars().all()
+        finally: db.close()
+        self.rnd=random.Random(a.seed+1); self._lock=threading.Lock(); self._q=iter(self.quotes)
+    def pick(self, seq):
+        with self._lock: return self.rnd.choice(seq)
+    def quote(self):
+        with self._lock: return next(self._q, None)
+    def request(self, ep):
+        """(method, path, json) döner; None: havuz tükendi."""
+        if ep=="login": return "POST","/auth/login",{"username":"bench","password":PASSWORD}
+        if ep=="stock_move":
+            # IN/OUT dönüşümlü: stok seviyesi sabit kalır, ilk iki depoda hammadde bol
+            mt=self.pick(["IN","OUT"]); wh=self.pick(self.whs[:2])
+            return "POST","/stock/move",{"item_code":self.pick(self.raw),"qty":1,"unit_price":10,"move_type":mt,
+                                         ("wh_to_code" if mt=="IN" else "wh_from_code"):wh,"ref":"BENCH"}
+        if ep=="snapshot": return "GET",f"/stock/snapshot?limit=500&warehouse_code={self.pick(self.whs)}",None
+        if ep=="doc_create":
+            return "POST","/docs/",{"doc_type":"QUOTE","party_code":self.pick(self.parties),
+                                    "lines":[{"item_code":self.pick(self.items),"qty":5,"unit_price":12.5} for _ in range(5)]}
+        if ep=="doc_convert":
+            q=self.quote(); return ("POST","/docs/convert",{"src_ids":[q],"dst_type":"ORDER"}) if q else None
+        if ep=="consume": return "POST","/production/consume",{"wo_id":self.pick(self.wos),"item_code":self.pick(self.raw),"qty":1,"warehouse_code":self.whs[0]}
+        if ep=="produce": return "POST","/production/produce",{"wo_id":self.pick(self.wos),"qty":1,"warehouse_code":self.whs[0]}
+        raise ValueError(ep)
+
+def server_timing(h:str):
+    # 'app;dur=1.2, db;dur=0.3;desc="4 queries"' -> (db ms, sorgu)
+    db_ms=q=None
+    for part in (h or "").split(","):
+        f=part.strip().split(";")
+        if f[0]=="db":
+            for x in f[1:]:
+                if x.startswith("dur="): db_ms=float(x[4:])
+                elif x.startswith("desc="): q=int(x[5:].strip('"').split()[0])
+    return db_ms, q
+
+def pct(sorted_vals, p):
+    # en yakın sıra yöntemi
+    if not sorted_vals: return None
+    return sorted_vals[min(len(sorted_vals)-1, max(0, int(round(p/100*len(sorted_vals)+0.5))-1))]
+
+def summarize(samples, wall):
+    lat=sorted(s[0] for s in samples if s[1]); errs=sum(1 for s in samples if not s[1])
+    dbs=[s[2] for s in samples if s[2] is not None]; qs=[s[3] for s in samples if s[3] is not None]
+    r=lambda x: round(x,3) if x is not None else None
+    return {"requests":len(samples), "errors":errs, "throughput_rps":r(len(samples)/wall if wall else 0.0),
+            "p50_ms":r(pct(lat,50)), "p95_ms":r(pct(lat,95)), "p99_ms":r(pct(lat,99)), "mean_ms":r(sum(lat)/len(lat) if lat else None),
+            "db_ms_mean":r(sum(dbs)/len(dbs) if dbs else None), "queries_mean":r(sum(qs)/len(qs) if qs else None)}
+
+def run_endpoint(send, fx, ep, n, concurrency):
+    """n isteği concurrency iş parçacığıyla gönderir; (gecikme ms, başarılı, db ms, sorgu) örnekleri."""
+    samples=[]; lock=threading.Lock(); left=itertools.count(); errors=[]
+    def worker():
+        while next(left)<n:
+            req=fx.request(ep)
+            if req is None: return
+            t=time.perf_counter(); status, st=send(*req); dt=(time.perf_counter()-t)*1000
+            ok=200<=status<300
+            if not ok and len(errors)<3: errors.append(status)
+            with lock: samples.append((dt, ok)+server_timing(st))
+    t0=time.perf_counter()
+    ths=[threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    for t in ths: t.start()
+    for t in ths: t.join()
+    res=summarize(samples, time.perf_counter()-t0)
+    if errors: res["sample_error_status"]=errors
+    return res
+
+def drive(send, fx, a, endpoints, concurrency):
+    out={}
+    for ep in endpoints:
+        n=a.login_requests if ep=="login" else a.requests
+        out[ep]=run_endpoint(send, fx, ep, n, concurrency)
+        print(f"  {ep:<12} n={out[ep]['requests']:<5} err={out[ep]['errors']:<3} rps={out[ep]['throughput_rps']:<9} "
+              f"p50={out[ep]['p50_ms']} p95={out[ep]['p95_ms']} p99={out[ep]['p99_ms']} q={out[ep]['queries_mean']}", flush=True)
+    return out
+
+def token(send_raw):
+    s,body=send_raw("POST","/auth/login",{"username":"bench","password":PASSWORD})
+    if s!=200: raise SystemExit(f"login failed: {s} {body}")
+    return {"Authorization":"Bearer "+body["access_token"]}
+
+def run_inprocess(A, a, endpoints):
+    from fastapi.testclient import TestClient
+    with TestClient(A.app) as c:
+        def raw(m,p,j=None,h=None): r=c.request(m,p,json=j,headers=h); return r.status_code, r.json()
+        hdr=token(raw); fx=Fixture(A, a)
+        def send(m,p,j): r=c.request(m,p,json=j,headers=hdr); return r.status_code, r.headers.get("server-timing")
+        # TestClient tek olay döngüsü portalı: eşzamanlılık anlamlı değil, tek istemci
+        return drive(send, fx, a, endpoints, 1)
+
+def free_port():
+    with socket.socket() as s: s.bind(("127.0.0.1",0)); return s.getsockname()[1]
+
+def run_uvicorn(A, a, endpoints):
+    import httpx
+    port=a.port or free_port(); base=f"http://127.0.0.1:{port}"
+    env=dict(os.environ, DB_URL=os.environ["DB_URL"], DB_AUTO_MIGRATE="0")
+    proc=subprocess.Popen([sys.executable,"-m","uvicorn","app:app","--host","127.0.0.1","--port",str(port),"--workers",str(a.workers),"--log-level","warning"],
+                          cwd=HERE, env=env)
+    try:
+        for _ in range(200):
+            try:
+                if httpx.get(base+"/health", timeout=1).status_code==200: break
+            except httpx.HTTPError: pass
+            if proc.poll() is not None: raise SystemExit("uvicorn exited")
+            time.sleep(0.1)
+        else: raise SystemExit("uvicorn did not start")
+        local=threading.local()
+        def client():
+            if not hasattr(local,"c"): local.c=httpx.Client(base_url=base, timeout=60)
+            return local.c
+        def raw(m,p,j=None,h=None): r=client().request(m,p,json=j,headers=h); return r.status_code, r.json()
+        hdr=token(raw); fx=Fixture(A, a)
+        def send(m,p,j): r=client().request(m,p,json=j,headers=hdr); return r.status_code, r.headers.get("server-timing")
+        return drive(send, fx, a, endpoints, a.concurrency)
+    finally:
+        proc.terminate()
+        try: proc.wait(10)
+        except subprocess.TimeoutExpired: proc.kill()
+
+# ---- Karşılaştırma ----
+def compare(cur, base, threshold):
+    """Mod/uç bazında p95 ve throughput farkı; eşiği aşanlar regressions listesine."""
+    rows=[]; regs=[]
+    for mode,eps in cur.get("results",{}).items():
+        for ep,r in eps.items():
+            b=base.get("results",{}).get(mode,{}).get(ep)
+            if not b: continue
+            d={"mode":mode,"endpoint":ep}
+            for k in ("p95_ms","p99_ms","throughput_rps"):
+                if r.get(k) is not None and b.get(k): d[k+"_change"]=round(r[k]/b[k]-1, 3)
+            d["regression"]=d.get("p95_ms_change",0)>threshold or d.get("throughput_rps_change",0)<-threshold
+            rows.append(d)
+            if d["regression"]: regs.append(f"{mode}/{ep}")
+    return {"baseline_meta":base.get("meta"), "threshold":threshold, "endpoints":rows, "regressions":regs}
+
+def git_rev():
+    try: return subprocess.run(["git","rev-parse","--short","HEAD"], cwd=HERE, capture_output=True, text=True).stdout.strip() or None
+    except OSError: return None
+
+def main(argv=None):
+    a=parse_args(argv)
+    try: import httpx  # noqa: F401  TestClient ve uvicorn istemcisi
+    except ImportError: raise SystemExit("httpx gerekli: pip install -r requirements-dev.txt")
+    endpoints=[e for e in (a.only.split(",") if a.only else ENDPOINTS) if e]
+    bad=set(endpoints)-set(ENDPOINTS)
+    if bad: raise SystemExit(f"unknown endpoints: {sorted(bad)}")
+    fresh=not (a.reuse and os.path.exists(a.db))
+    if fresh:
+        for sfx in ("","-wal","-shm"):
+            if os.path.exists(a.db+sfx): os.remove(a.db+sfx)
+    # app motorları import anında kurulur: DB_URL önce ayarlanmalı
+    os.environ["DB_URL"]=f"sqlite:///{os.path.abspath(a.db)}"; os.environ.pop("DB_READ_URL", None)
+    sys.path.insert(0, HERE)
+    import app as A
+    seed_s=None
+    if fresh:
+        print(f"seeding {a.db} ...", flush=True); seed_s=seed(A, a); print(f"seeded in {seed_s}s", flush=True)
+    meta={"timestamp":datetime.utcnow().isoformat(timespec="seconds")+"Z", "git_rev":git_rev(), "python":platform.python_version(),
+          "platform":platform.platform(), "seed_seconds":seed_s,
+          "dataset":{k:getattr(a,k) for k in ("items","warehouses","parties","moves","docs","wos","seed")} if fresh else "reused",
+          "requests":a.requests, "login_requests":a.login_requests, "concurrency":a.concurrency, "workers":a.workers}
+    results={}
+    if a.mode in ("inprocess","both"): print("inprocess:", flush=True); results["inprocess"]=run_inprocess(A, a, endpoints)
+    if a.mode in ("uvicorn","both"): print(f"uvicorn (c={a.concurrency}, workers={a.workers}):", flush=True); results["uvicorn"]=run_uvicorn(A, a, endpoints)
+    out={"meta":meta, "results":results}
+    if a.baseline:
+        with open(a.baseline) as f: out["comparison"]=compare(out, json.load(f), a.threshold)
+        for d in out["comparison"]["endpoints"]:
+            print(f"  {d['mode']}/{d['endpoint']:<12} p95 {d.get('p95_ms_change',0):+.1%}  rps {d.get('throughput_rps_change',0):+.1%}{'  REGRESSION' if d['regression'] else ''}")
+    with open(a.out,"w") as f: json.dump(out, f, indent=2)
+    print("wrote", a.out)
+    if a.fail_on_regression and out.get("comparison",{}).get("regressions"): sys.exit(1)
+
+if __name__=="__main__":
+    main()